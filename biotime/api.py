@@ -1,30 +1,33 @@
 import frappe
 import json
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from frappe import _
-from frappe import publish_progress
-from frappe.utils import get_first_day, get_last_day, today, add_to_date
+from frappe.utils import get_first_day, get_last_day, today, add_to_date, cint, get_datetime
 from frappe.utils import add_to_date
 
-from datetime import datetime
+from biotime.client import get_tokan, get_client
+from biotime.ingestion import CheckinWriter, EmployeeMap, UnmatchedPunches, get_commit_every, stage_transactions
+from biotime.utils import ProgressReporter, bulk_update_column
+from biotime.reference import get_default_area_id, resolve_reference_id
+from biotime.mirror import ensure_employee_mirror, get_content_hash, get_mirror_employees, get_unmapped_emp_codes
 
 # Biometric Integration
 
 @frappe.whitelist()
 def discover_biotime_employees():
     """Découvre les employés présents dans BioTime mais absents dans ERPNext"""
-    main_url = get_url()
-    headers = get_auth_headers()
-    
     try:
         # Console de débogage
         print("🔍 DEBUG: Début de découverte des employés BioTime")
-        print(f"🌐 URL BioTime: {main_url}")
-        print(f"🔑 Headers auth: {headers}")
         
-        # Récupérer tous les employés depuis BioTime
-        biotime_employees = fetch_all_biotime_employees(headers, main_url)
-        print(f"👥 Employés BioTime trouvés: {len(biotime_employees)}")
+        # Employés BioTime lus depuis le miroir local (BioTime Employee), rafraîchi par le planificateur
+        ensure_employee_mirror()
+        biotime_count = frappe.db.count("BioTime Employee")
+        print(f"👥 Employés BioTime (miroir): {biotime_count}")
+        
+        # Seules les fiches sans Employee correspondant sont chargées
+        biotime_employees = get_mirror_employees(get_unmapped_emp_codes())
         
         # Afficher les premiers employés pour débogage
         if biotime_employees:
@@ -68,7 +71,7 @@ def discover_biotime_employees():
         
         return {
             "status": "success",
-            "biotime_count": len(biotime_employees),
+            "biotime_count": biotime_count,
             "erpnext_count": len(erpnext_employees),
             "missing_count": len(missing_employees),
             "message": f"Trouvé {len(missing_employees)} employés à valider"
@@ -79,63 +82,6 @@ def discover_biotime_employees():
         frappe.log_error(message=str(e), title="Erreur Découverte Employés")
         return {"status": "error", "message": str(e)}
 
-def fetch_all_biotime_employees(headers, main_url):
-    """Récupère tous les employés depuis BioTime avec pagination et débogage"""
-    employees_list = []
-    is_next_page = True
-    url = f"{main_url}/personnel/api/employees/"
-    page_count = 0
-    
-    print(f"🔗 URL initiale: {url}")
-    
-    while is_next_page:
-        page_count += 1
-        print(f"📄 Traitement page {page_count}...")
-        
-        try:
-            response = requests.get(url, headers=headers, timeout=30)
-            print(f"📡 Status Code: {response.status_code}")
-            
-            if response.ok:
-                res = response.json()
-                employees = res.get("data", [])
-                total_count = res.get("count", 0)
-                
-                print(f"👥 Page {page_count}: {len(employees)} employés récupérés")
-                print(f"📊 Total dans BioTime: {total_count}")
-                
-                # Afficher structure d'un employé pour débogage
-                if employees and page_count == 1:
-                    sample_emp = employees[0]
-                    print(f"📋 Structure employé exemple:")
-                    print(f"   - emp_code: {sample_emp.get('emp_code')}")
-                    print(f"   - emp_name: {sample_emp.get('emp_name')}")
-                    print(f"   - department: {sample_emp.get('department')}")
-                    print(f"   - position: {sample_emp.get('position')}")
-                    print(f"   - Toutes les clés: {list(sample_emp.keys())}")
-                
-                employees_list.extend(employees)
-                url = res.get("next")
-                if not url:
-                    is_next_page = False
-                    print("✅ Dernière page atteinte")
-                else:
-                    print(f"➡️ Page suivante: {url}")
-            else:
-                print(f"❌ Erreur HTTP {response.status_code}: {response.text}")
-                frappe.log_error(
-                    message=f"Erreur API BioTime: {response.status_code} - {response.text}", 
-                    title="Erreur Récupération Employés"
-                )
-                break
-        except Exception as e:
-            print(f"❌ Exception page {page_count}: {str(e)}")
-            frappe.log_error(message=str(e), title="Erreur API BioTime")
-            break
-    
-    print(f"✅ Total employés récupérés: {len(employees_list)} sur {page_count} pages")
-    return employees_list
-
 def find_missing_employees(biotime_employees, erpnext_employees):
     """Trouve les employés présents dans BioTime mais absents dans ERPNext"""
     erpnext_device_ids = {emp.attendance_device_id for emp in erpnext_employees if emp.attendance_device_id}
@@ -173,68 +119,116 @@ def find_missing_employees(biotime_employees, erpnext_employees):
     
     return missing_employees
 
+# Statuts jamais modifiés par la réconciliation
+KEPT_DISCOVERY_STATUSES = ("Rejected", "Employee Created")
+# Champs issus de BioTime (mis à jour quand les données BioTime changent)
+DISCOVERY_BIOTIME_FIELDS = ("employee_name", "first_name", "last_name", "department", "position",
+                            "mobile", "office_tel", "biotime_employee", "biotime_data_hash")
+
 def save_discovered_employees(missing_employees):
-    """Sauvegarde les employés découverts pour validation"""
-    # Supprimer les anciennes découvertes
-    frappe.db.delete("Employee Discovery", {})
+    """Réconcilie Employee Discovery avec les employés découverts (par device_id)
     
-    for emp in missing_employees:
-        discovery_doc = frappe.new_doc("Employee Discovery")
-        discovery_doc.device_id = emp["device_id"]
-        discovery_doc.employee_name = emp["name"]
-        discovery_doc.department = emp["department"]
-        discovery_doc.position = emp["position"]
-        
-        # Nouveaux champs avec valeurs par défaut
-        biotime_data = emp.get("biotime_data", {})
-        
-        # Extraire first_name et last_name depuis les données BioTime
-        discovery_doc.first_name = biotime_data.get("first_name", "")
-        discovery_doc.last_name = biotime_data.get("last_name", "")
-        
-        # Si pas de first_name/last_name, essayer d'extraire du employee_name
-        if not discovery_doc.first_name and discovery_doc.employee_name:
-            name_parts = discovery_doc.employee_name.split()
-            discovery_doc.first_name = name_parts[0] if name_parts else "Employé"
-            discovery_doc.last_name = " ".join(name_parts[1:]) if len(name_parts) > 1 else ""
-        
-        # Valeurs par défaut
-        discovery_doc.gender = biotime_data.get("gender", "M") if biotime_data.get("gender") in ["M", "F"] else "Male"
-        if discovery_doc.gender == "M":
-            discovery_doc.gender = "Male"
-        elif discovery_doc.gender == "F":
-            discovery_doc.gender = "Female"
-        
-        # Date de naissance par défaut
-        birthday = biotime_data.get("birthday")
-        if birthday:
-            discovery_doc.date_of_birth = birthday
-        else:
-            discovery_doc.date_of_birth = "1980-01-01"
-        
-        # Date d'embauche par défaut (aujourd'hui)
-        hire_date = biotime_data.get("hire_date")
-        if hire_date:
-            discovery_doc.date_of_joining = hire_date
-        else:
-            discovery_doc.date_of_joining = frappe.utils.today()
-        
-        # Email personnel si disponible
-        email = biotime_data.get("email")
-        if email:
-            discovery_doc.personal_email = email
-        
-        discovery_doc.biotime_data = json.dumps(emp["biotime_data"])
-        discovery_doc.status = "Pending Validation"
-        discovery_doc.save()
+    Nouveaux: insertion groupée. Données BioTime modifiées: mise à jour des seuls champs BioTime.
+    Plus manquants: suppression des découvertes en attente ou validées.
+    Inchangés, rejetés et déjà créés: non modifiés (les saisies utilisateur sont conservées).
+    """
+    discovered = {emp["device_id"]: emp for emp in missing_employees}
+    existing = {
+        doc.device_id: doc for doc in frappe.get_all(
+            "Employee Discovery", fields=["name", "device_id", "status", "biotime_data_hash"]
+        )
+    }
+    
+    new_records = [make_discovery_values(emp) for device_id, emp in discovered.items() if device_id not in existing]
+    changed_records = []
+    for device_id, emp in discovered.items():
+        current = existing.get(device_id)
+        if not current or current.status in KEPT_DISCOVERY_STATUSES:
+            continue
+        values = make_discovery_values(emp)
+        if values["biotime_data_hash"] != current.biotime_data_hash:
+            changed_records.append((current.name, values))
+    stale = [
+        doc.name for device_id, doc in existing.items()
+        if device_id not in discovered and doc.status not in KEPT_DISCOVERY_STATUSES
+    ]
+    
+    commit_every = get_commit_every()
+    progress = ProgressReporter(title="Saving Employee Discoveries...", total=len(new_records) + len(changed_records))
+    
+    for start in range(0, len(new_records), commit_every):
+        insert_discoveries(new_records[start:start + commit_every])
+        frappe.db.commit()
+        progress.update(min(start + commit_every, len(new_records)))
+    
+    for i, (name, values) in enumerate(changed_records, 1):
+        frappe.db.set_value("Employee Discovery", name, {field: values[field] for field in DISCOVERY_BIOTIME_FIELDS})
+        # Transactions courtes: un commit tous les N enregistrements
+        if i % commit_every == 0:
+            frappe.db.commit()
+        progress.update(len(new_records) + i)
+    
+    if stale:
+        frappe.db.delete("Employee Discovery", {"name": ["in", stale]})
     
     frappe.db.commit()
+    progress.finish()
+    print(f"📝 Découvertes: {len(new_records)} nouvelles, {len(changed_records)} mises à jour, {len(stale)} retirées")
+    return frappe._dict(created=len(new_records), updated=len(changed_records), deleted=len(stale))
+
+def make_discovery_values(emp):
+    """Valeurs d'une Employee Discovery depuis un employé découvert"""
+    biotime_data = emp.get("biotime_data", {})
+    values = frappe._dict(
+        device_id=emp["device_id"],
+        employee_name=emp["name"],
+        department=emp["department"],
+        position=emp["position"],
+        # Extraire first_name et last_name depuis les données BioTime
+        first_name=biotime_data.get("first_name", ""),
+        last_name=biotime_data.get("last_name", ""),
+    )
+    
+    # Si pas de first_name/last_name, essayer d'extraire du employee_name
+    if not values.first_name and values.employee_name:
+        name_parts = values.employee_name.split()
+        values.first_name = name_parts[0] if name_parts else "Employé"
+        values.last_name = " ".join(name_parts[1:]) if len(name_parts) > 1 else ""
+    
+    # Valeurs par défaut
+    values.gender = "Female" if biotime_data.get("gender") == "F" else "Male"
+    # Date de naissance par défaut
+    values.date_of_birth = biotime_data.get("birthday") or "1980-01-01"
+    # Date d'embauche par défaut (aujourd'hui)
+    values.date_of_joining = biotime_data.get("hire_date") or frappe.utils.today()
+    # Email personnel si disponible
+    values.personal_email = biotime_data.get("email") or None
+    
+    # Champs BioTime consommés à la création; la fiche brute reste dans le miroir (clé emp_code)
+    values.mobile = biotime_data.get("mobile") or None
+    values.office_tel = biotime_data.get("office_tel") or None
+    values.biotime_employee = emp["device_id"]
+    values.biotime_data_hash = get_content_hash(biotime_data)
+    values.status = "Pending Validation"
+    return values
+
+def insert_discoveries(records):
+    """INSERT multi-lignes d'Employee Discovery (sans save() par ligne)"""
+    if not records:
+        return
+    timestamp = frappe.utils.now()
+    fields = list(records[0].keys()) + ["name", "owner", "modified_by", "creation", "modified", "docstatus"]
+    values = [
+        list(record.values()) + [frappe.generate_hash(length=10), frappe.session.user, frappe.session.user,
+                                 timestamp, timestamp, 0]
+        for record in records
+    ]
+    frappe.db.bulk_insert("Employee Discovery", fields, values)
 
 @frappe.whitelist()
-def sync_erpnext_employees_to_biotime():
-    """Synchronise les employés ERPNext vers BioTime"""
-    main_url = get_url()
-    headers = get_auth_headers()
+def sync_erpnext_employees_to_biotime(user=None):
+    """Synchronise les employés ERPNext vers BioTime (tous, en parallèle)"""
+    client = get_client()
     
     try:
         print("🔄 DEBUG: Début synchronisation ERPNext vers BioTime")
@@ -242,7 +236,8 @@ def sync_erpnext_employees_to_biotime():
         # Récupérer employés ERPNext sans device_id (nouveaux employés)
         new_employees = frappe.db.get_all(
             "Employee",
-            fields=["name", "employee_name", "department", "designation", "employment_type"],
+            fields=["name", "employee_name", "department", "designation", "employment_type",
+                    "gender", "date_of_birth", "date_of_joining", "cell_number"],
             filters=[
                 ["status", "=", "Active"],
                 ["attendance_device_id", "in", [None, ""]]
@@ -258,325 +253,206 @@ def sync_erpnext_employees_to_biotime():
                 "created_count": 0
             }
         
-        created_count = 0
-        failed_count = 0
-        
-        for emp in new_employees[:5]:  # Limiter à 5 pour test
-            print(f"🆕 Création employé: {emp.employee_name}")
-            
-            success = create_employee_in_biotime(emp, headers, main_url)
-            if success:
-                created_count += 1
-                print(f"✅ Employé créé avec succès: {emp.employee_name}")
-            else:
-                failed_count += 1
-                print(f"❌ Échec création: {emp.employee_name}")
-        
+        results = push_employees_to_biotime(new_employees, client)
+        created_count = len([r for r in results if r.device_id])
+        failed_count = len(results) - created_count
         print(f"📊 Résumé: {created_count} créés, {failed_count} échecs")
         
-        return {
+        result = {
             "status": "success",
             "created_count": created_count,
             "failed_count": failed_count,
+            "results": results,
             "message": f"Synchronisation terminée: {created_count} employés créés, {failed_count} échecs"
         }
+        if user:
+            # Exécution en arrière-plan: résumé envoyé à l'utilisateur
+            frappe.publish_realtime("msgprint", result["message"], user=user)
+        return result
         
     except Exception as e:
         print(f"❌ ERREUR synchronisation: {str(e)}")
         frappe.log_error(message=str(e), title="Erreur Sync ERPNext vers BioTime")
         return {"status": "error", "message": str(e)}
 
-def create_employee_in_biotime(employee_data, headers, main_url):
-    """Crée un employé dans BioTime selon la documentation officielle"""
+def push_employees_to_biotime(employees, client):
+    """Crée les employés dans BioTime: références résolues une fois, POST en parallèle, device_id écrits par lot"""
+    # Headers et références (zones, départements, postes) résolus une seule fois, ici:
+    # les threads du pool n'ont pas de contexte frappe
+    client.get_headers()
+    area_id = get_default_biotime_area_id()
+    department_ids = {dept: get_biotime_department_id(dept) for dept in {emp.department for emp in employees}}
+    position_ids = {desig: get_biotime_position_id(desig) for desig in {emp.designation for emp in employees}}
+    
+    payloads = [
+        (emp, build_biotime_employee_data(emp, area_id, department_ids.get(emp.department), position_ids.get(emp.designation)))
+        for emp in employees
+    ]
+    
+    concurrency = cint(frappe.db.get_single_value("BioTime Setting", "push_concurrency")) or 4
+    concurrency = max(1, min(concurrency, client.pool_size))
+    progress = ProgressReporter(title="Creating Employees in BioTime...", total=len(payloads))
+    results = []
+    
+    # Pool borné; pas de ré-authentification dans les threads (contexte frappe absent)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [(emp, data, executor.submit(post_biotime_employee, client, data, False)) for emp, data in payloads]
+        for emp, data, future in futures:
+            device_id, error, status_code = future.result()
+            if status_code == 401:
+                # Token expiré pendant le run: nouvelle tentative ici, avec ré-authentification
+                device_id, error, status_code = post_biotime_employee(client, data)
+            results.append(frappe._dict(employee=emp.name, device_id=device_id, error=error))
+            progress.update()
+    
+    # Écriture des attendance_device_id: une requête par lot
+    bulk_update_column("Employee", "attendance_device_id", {r.employee: r.device_id for r in results if r.device_id})
+    frappe.db.commit()
+    progress.finish()
+    
+    failures = [r for r in results if not r.device_id]
+    if failures:
+        frappe.log_error(
+            message="\n".join(f"{r.employee}: {r.error}" for r in failures),
+            title=f"Erreur Création BioTime ({len(failures)} employés)"
+        )
+    return results
+
+def build_biotime_employee_data(employee_data, area_id, department_id, position_id):
+    """Données BioTime d'un employé ERPNext (IDs de zone, département et poste déjà résolus)"""
+    # ✅ Structure COMPLÈTE selon la documentation BioTime 9.0 (correction erreur 500)
+    biotime_data = {
+        # Champs obligatoires de base
+        "emp_code": employee_data.name,  # Code employé unique
+        "department": department_id,  # ID département  
+        "area": [area_id] if area_id else [1],  # Array d'IDs de zones
+        
+        # Champs souvent requis par BioTime (éviter erreur 500)
+        "hire_date": employee_data.date_of_joining.strftime('%Y-%m-%d') if employee_data.date_of_joining else "2023-01-01",
+        "verify_mode": 0,  # Mode de vérification par défaut
+        "card_no": "",  # Numéro de carte (vide par défaut)
+        "acc_group": 1,  # Groupe d'accès par défaut
+        "acc_timezone": 1,  # Fuseau horaire par défaut
+        "gender": "M",  # Genre par défaut
+        "birthday": "1990-01-01",  # Date de naissance par défaut
+        "address": "",  # Adresse vide
+        "postcode": "",  # Code postal vide
+        "office_tel": "",  # Téléphone bureau
+        "contact_tel": "",  # Téléphone contact
+        "mobile": "",  # Mobile
+        "national_no": "",  # Numéro national
+        "passport_no": "",  # Numéro passeport
+        "photo": "",  # Photo (vide)
+        "notes": f"Créé depuis ERPNext - {employee_data.name}",  # Notes
+        "privilege": 0,  # Privilèges par défaut
+        "password": "",  # Mot de passe vide
+        "is_active": True,  # Actif
+        "create_time": frappe.utils.now_datetime().strftime('%Y-%m-%d %H:%M:%S'),
+    }
+    
+    # Ajouter les champs nom s'ils existent
+    if employee_data.employee_name:
+        name_parts = employee_data.employee_name.split()
+        if len(name_parts) > 0:
+            biotime_data["first_name"] = name_parts[0]
+        if len(name_parts) > 1:
+            biotime_data["last_name"] = " ".join(name_parts[1:])
+    
+    # Ajouter données existantes d'ERPNext si disponibles
+    if employee_data.get("gender"):
+        biotime_data["gender"] = "M" if employee_data.gender == "Male" else "F"
+    
+    if employee_data.get("date_of_birth"):
+        biotime_data["birthday"] = employee_data.date_of_birth.strftime('%Y-%m-%d')
+    
+    if employee_data.get("cell_number"):
+        biotime_data["mobile"] = employee_data.cell_number
+    
+    # Ajouter le poste si disponible
+    if position_id:
+        biotime_data["position"] = position_id
+    
+    return biotime_data
+
+def post_biotime_employee(client, biotime_data, reauth=True):
+    """POST d'un employé (utilisable dans un thread: aucun accès base): (device_id, erreur, status)"""
+    # ✅ Validation données avant envoi (éviter erreur 500)
+    required_fields = ["emp_code", "department", "area", "hire_date"]
+    missing_fields = [field for field in required_fields if not biotime_data.get(field)]
+    if missing_fields:
+        return None, f"Champs obligatoires manquants: {missing_fields}", None
+    
+    # ✅ Envoyer vers BioTime selon la documentation officielle
+    url = "/personnel/api/employees/"
     try:
-        # 🔄 Test avec token frais pour création (nouvelles permissions potentielles)
-        print("🔄 Génération token frais pour création...")
-        fresh_token = get_tokan()  # ✅ Correction du nom de fonction
-        if fresh_token:
-            # Test plusieurs formats de JWT
-            possible_headers = [
-                {'Authorization': f'JWT {fresh_token}', 'Content-Type': 'application/json'},
-                {'Authorization': f'Bearer {fresh_token}', 'Content-Type': 'application/json'},
-                {'Authorization': f'Token {fresh_token}', 'Content-Type': 'application/json'},
-            ]
-            
-            # Test chaque format rapidement sur GET pour voir lequel fonctionne
-            test_url = f"{main_url}/personnel/api/employees/?page_size=1"
-            working_headers = None
-            
-            for i, test_headers in enumerate(possible_headers):
-                format_name = test_headers['Authorization'].split(' ')[0]
-                print(f"🧪 Test format {format_name} sur GET...")
-                
-                try:
-                    test_resp = requests.get(test_url, headers=test_headers, timeout=5)
-                    print(f"   GET {format_name}: {test_resp.status_code}")
-                    
-                    if test_resp.ok:
-                        print(f"✅ Format {format_name} fonctionne pour GET!")
-                        working_headers = test_headers
-                        break
-                        
-                except Exception as e:
-                    print(f"   Erreur {format_name}: {str(e)[:50]}")
-            
-            if working_headers:
-                headers = working_headers
-                print(f"🆕 Utilisation format validé: {headers['Authorization'].split(' ')[0]}")
-            else:
-                headers = possible_headers[0]  # JWT par défaut
-                print("⚠️ Aucun format validé, utilisation JWT par défaut")
-        else:
-            print("⚠️  Échec génération token frais, utilisation token initial")
-        
-        # Récupérer l'ID de la première zone disponible (obligatoire)
-        area_id = get_default_biotime_area_id(headers, main_url)
-        
-        # ✅ Structure COMPLÈTE selon la documentation BioTime 9.0 (correction erreur 500)
-        biotime_data = {
-            # Champs obligatoires de base
-            "emp_code": employee_data.name,  # Code employé unique
-            "department": get_biotime_department_id(employee_data.department),  # ID département  
-            "area": [area_id] if area_id else [1],  # Array d'IDs de zones
-            
-            # Champs souvent requis par BioTime (éviter erreur 500)
-            "hire_date": employee_data.date_of_joining.strftime('%Y-%m-%d') if employee_data.date_of_joining else "2023-01-01",
-            "verify_mode": 0,  # Mode de vérification par défaut
-            "card_no": "",  # Numéro de carte (vide par défaut)
-            "acc_group": 1,  # Groupe d'accès par défaut
-            "acc_timezone": 1,  # Fuseau horaire par défaut
-            "gender": "M",  # Genre par défaut
-            "birthday": "1990-01-01",  # Date de naissance par défaut
-            "address": "",  # Adresse vide
-            "postcode": "",  # Code postal vide
-            "office_tel": "",  # Téléphone bureau
-            "contact_tel": "",  # Téléphone contact
-            "mobile": "",  # Mobile
-            "national_no": "",  # Numéro national
-            "passport_no": "",  # Numéro passeport
-            "photo": "",  # Photo (vide)
-            "notes": f"Créé depuis ERPNext - {employee_data.name}",  # Notes
-            "privilege": 0,  # Privilèges par défaut
-            "password": "",  # Mot de passe vide
-            "is_active": True,  # Actif
-            "create_time": frappe.utils.now_datetime().strftime('%Y-%m-%d %H:%M:%S'),
-        }
-        
-        # Ajouter les champs nom s'ils existent
-        if employee_data.employee_name:
-            name_parts = employee_data.employee_name.split()
-            if len(name_parts) > 0:
-                biotime_data["first_name"] = name_parts[0]
-            if len(name_parts) > 1:
-                biotime_data["last_name"] = " ".join(name_parts[1:])
-        
-        # Ajouter données existantes d'ERPNext si disponibles
-        if hasattr(employee_data, 'gender') and employee_data.gender:
-            biotime_data["gender"] = "M" if employee_data.gender == "Male" else "F"
-        
-        if hasattr(employee_data, 'date_of_birth') and employee_data.date_of_birth:
-            biotime_data["birthday"] = employee_data.date_of_birth.strftime('%Y-%m-%d')
-        
-        if hasattr(employee_data, 'cell_number') and employee_data.cell_number:
-            biotime_data["mobile"] = employee_data.cell_number
-        
-        # Ajouter le poste si disponible
-        position_id = get_biotime_position_id(employee_data.designation)
-        if position_id:
-            biotime_data["position"] = position_id
-        
-        print(f"📤 Données complètes envoyées à BioTime:")
-        print(json.dumps(biotime_data, indent=2, ensure_ascii=False))
-        
-        # ✅ Validation données avant envoi (éviter erreur 500)
-        required_fields = ["emp_code", "department", "area", "hire_date"]
-        missing_fields = [field for field in required_fields if not biotime_data.get(field)]
-        
-        if missing_fields:
-            error_msg = f"❌ Champs obligatoires manquants: {missing_fields}"
-            print(error_msg)
-            return {"error": error_msg}
-        
-        print(f"✅ Validation OK - Tous les champs requis présents")
-        
-        # ✅ Envoyer vers BioTime selon la documentation officielle
-        url = f"{main_url}/personnel/api/employees/"
-        
-        print(f"🌐 URL: {url}")
-        print(f"🔑 Headers: {headers}")
-        print(f"🔐 Token debug: '{headers.get('Authorization', 'MISSING')}'")
-        print(f"📦 Data debug: {type(biotime_data)} - {biotime_data}")
-        
-        # Test préliminaire: vérifier si l'endpoint accepte nos requêtes
-        print("🧪 Test préliminaire: GET sur l'endpoint de création...")
-        test_response = requests.get(url, headers=headers, timeout=10)
-        print(f"🧪 GET Status: {test_response.status_code}")
-        
-        if test_response.status_code == 401:
-            print("❌ GET échoue aussi avec 401, problème d'authentification de base")
-            print(f"   Headers testés: {headers}")
-            print(f"   WWW-Authenticate: {test_response.headers.get('WWW-Authenticate', 'Non présent')}")
-            
-            # Test avec token complètement nouveau
-            print("🔄 Test avec token totalement frais...")
-            newest_token = get_tokan()
-            if newest_token and newest_token != headers.get('Authorization', '').replace('JWT ', ''):
-                headers['Authorization'] = f'JWT {newest_token}'
-                print(f"🆕 Nouveau token: {newest_token[:20]}...")
-                
-                retry_test = requests.get(url, headers=headers, timeout=5)
-                print(f"   Retry GET: {retry_test.status_code}")
-                
-                if retry_test.status_code == 401:
-                    print("❌ Même avec nouveau token, problème persiste")
-                    print("💡 Le problème pourrait être:")
-                    print("   • Permissions utilisateur insuffisantes")
-                    print("   • Format d'URL incorrect")
-                    print("   • Configuration serveur BioTime")
-        
-        # Utiliser json= pour l'encodage automatique (plus fiable)
-        print("📡 Envoi POST pour création employé...")
-        response = requests.post(url, json=biotime_data, headers=headers, timeout=30)
+        response = client.post(url, json=biotime_data, reauth=reauth)
+        if response.status_code == 500:
+            # Erreur 500 - Problème serveur BioTime: tentative avec données minimales
+            minimal_data = {
+                "emp_code": biotime_data["emp_code"],
+                "department": biotime_data["department"], 
+                "area": biotime_data["area"],
+                "first_name": biotime_data.get("first_name", "Employé"),
+                "last_name": biotime_data.get("last_name", "ERPNext")
+            }
+            response = client.post(url, json=minimal_data, reauth=reauth)
         
-        print(f"📡 Réponse BioTime Status: {response.status_code}")
-        print(f"📡 Réponse BioTime Headers: {dict(response.headers)}")
-        print(f"📡 Réponse BioTime Body: {response.text[:500]}...")  # Limiter l'affichage
+        if not response.ok:
+            return None, f"{response.status_code} - {response.text[:500]}", response.status_code
         
-        if response.ok:
-            # Vérifier si la réponse est du JSON valide
-            try:
-                response_data = response.json()
-                print(f"✅ Réponse JSON parsée: {response_data}")
-                
-                biotime_emp_code = response_data.get("emp_code")
-                biotime_emp_id = response_data.get("id")
-                
-                # Mettre à jour ERPNext avec le device_id (utiliser emp_code ou id)
-                device_id = biotime_emp_code or str(biotime_emp_id)
-                if device_id:
-                    frappe.db.set_value("Employee", employee_data.name, "attendance_device_id", device_id)
-                    frappe.db.commit()
-                    print(f"✅ Device ID mis à jour: {device_id}")
-                    return True
-                else:
-                    print("⚠️ Pas d'emp_code ni d'id dans la réponse")
-                    return False
-                
-            except json.JSONDecodeError as json_err:
-                print(f"❌ Erreur parsing JSON: {str(json_err)}")
-                print(f"❌ Réponse brute: '{response.text}'")
-                return False
-                
-        else:
-            # Gestion spécialisée des erreurs selon le code
-            if response.status_code == 500:
-                print("❌ Erreur 500 - Problème serveur BioTime")
-                print("💡 Suggestions pour corriger l'erreur 500:")
-                print("   • Vérifiez que tous les champs obligatoires sont fournis")
-                print("   • Confirmez que l'ID département existe dans BioTime")
-                print("   • Vérifiez que l'area_id est valide")
-                print("   • Contrôlez que emp_code est unique")
-                
-                # Tentative avec données minimales
-                print("🔄 Tentative avec données minimales...")
-                minimal_data = {
-                    "emp_code": biotime_data["emp_code"],
-                    "department": biotime_data["department"], 
-                    "area": biotime_data["area"],
-                    "first_name": biotime_data.get("first_name", "Employé"),
-                    "last_name": biotime_data.get("last_name", "ERPNext")
-                }
-                
-                print(f"📤 Données minimales: {json.dumps(minimal_data, indent=2)}")
-                retry_response = requests.post(url, json=minimal_data, headers=headers, timeout=30)
-                
-                print(f"🔄 Retry Status: {retry_response.status_code}")
-                if retry_response.ok:
-                    try:
-                        result = retry_response.json()
-                        print("✅ Succès avec données minimales!")
-                        
-                        device_id = result.get("emp_code") or str(result.get("id"))
-                        if device_id:
-                            frappe.db.set_value("Employee", employee_data.name, "attendance_device_id", device_id)
-                            frappe.db.commit()
-                            print(f"✅ Device ID mis à jour: {device_id}")
-                            return True
-                            
-                    except json.JSONDecodeError:
-                        print("✅ Succès avec données minimales (réponse non-JSON)")
-                        return True
-                else:
-                    print(f"❌ Échec même avec données minimales: {retry_response.status_code}")
-                    
-            print(f"❌ Erreur création BioTime: {response.status_code} - {response.text}")
-            return False
-            
+        try:
+            result = response.json()
+        except ValueError:
+            # Succès sans corps JSON: le code envoyé est le device_id
+            return biotime_data["emp_code"], None, response.status_code
+        
+        # device_id: emp_code ou id retourné par BioTime
+        device_id = result.get("emp_code") or (str(result.get("id")) if result.get("id") else None)
+        if not device_id:
+            return None, "Pas d'emp_code ni d'id dans la réponse", response.status_code
+        return device_id, None, response.status_code
     except Exception as e:
-        print(f"❌ Exception création BioTime: {str(e)}")
-        frappe.log_error(
-            message=f"Erreur création employé {employee_data.employee_name}: {str(e)}",
-            title="Erreur Création BioTime"
-        )
-        return False
+        return None, str(e), None
 
 def get_biotime_department_id(erpnext_dept):
-    """Récupère l'ID du département BioTime"""
+    """Récupère l'ID du département BioTime (département 1 par défaut, pour la création)"""
+    if not erpnext_dept:
+        return None
+    
+    # Retourner département par défaut
+    return find_biotime_department_id(erpnext_dept) or 1
+
+def find_biotime_department_id(erpnext_dept):
+    """ID du département BioTime, None s'il ne peut pas être résolu"""
     if not erpnext_dept:
         return None
     
-    # Chercher dans les mappings
+    # Chercher dans les mappings, sinon le nom du département ERPNext
     mapping = frappe.db.get_value(
         "Department Mapping",
         {"erpnext_department": erpnext_dept},
         "biotime_department"
     )
+    department_name = mapping or frappe.db.get_value("Department", erpnext_dept, "department_name")
     
-    if mapping:
-        # TODO: Ici, il faudrait faire un appel API pour récupérer l'ID du département
-        # Pour l'instant, retournons 1 (département par défaut)
-        return 1
-    
-    # Retourner département par défaut
-    return 1
+    # ID réel depuis les références BioTime en cache
+    return resolve_reference_id("departments", department_name)
 
 def get_biotime_position_id(erpnext_designation):
     """Récupère l'ID du poste BioTime"""
     if not erpnext_designation:
         return None
     
-    # TODO: Implémenter la recherche de poste via API
-    # Pour l'instant, retournons None
-    return None
+    # Poste BioTime de même nom (références en cache)
+    return resolve_reference_id("positions", erpnext_designation)
 
-def get_default_biotime_area_id(headers, main_url):
+def get_default_biotime_area_id():
     """Récupère l'ID d'une zone BioTime appropriée (évite 'Pas autorisé')"""
     try:
-        # Récupérer les zones disponibles
-        url = f"{main_url}/personnel/api/areas/"
-        response = requests.get(url, headers=headers, timeout=10)
-        
-        if response.ok:
-            data = response.json()
-            areas = data.get('data', [])
-            
-            if areas and len(areas) > 0:
-                # Priorité 1: Chercher une zone qui n'est PAS "Pas autorisé"
-                for area in areas:
-                    area_name = area.get('area_name', '').lower()
-                    if area_name not in ['pas autorisé', 'pas autorise', 'unauthorized', 'restricted']:
-                        area_id = area.get('id')
-                        print(f"🏢 Zone préférée sélectionnée: ID {area_id} - {area.get('area_name', 'Unknown')}")
-                        return area_id
-                
-                # Priorité 2: Si toutes les zones sont restrictives, utiliser la première quand même
-                area_id = areas[0].get('id')
-                area_name = areas[0].get('area_name', 'Unknown')
-                print(f"⚠️ Seule zone disponible: ID {area_id} - {area_name}")
-                print(f"🔍 Toutes les zones disponibles:")
-                for i, area in enumerate(areas[:5]):  # Afficher les 5 premières
-                    print(f"   {i+1}. ID {area.get('id')} - {area.get('area_name', 'N/A')}")
-                return area_id
+        # Zones BioTime en cache: plus de GET /personnel/api/areas/ par employé
+        area_id = get_default_area_id()
+        if area_id:
+            return area_id
         
         print("⚠️ Aucune zone trouvée via API, utilisation de zone par défaut ID 1")
         return 1
@@ -591,13 +467,11 @@ def get_default_biotime_area_id(headers, main_url):
 @frappe.whitelist()
 def debug_biotime_raw_data():
     """Fonction de débogage pour voir les données brutes BioTime"""
-    main_url = get_url()
-    headers = get_auth_headers()
+    client = get_client()
     
     try:
         print("🔍 === DÉBOGAGE DONNÉES BIOTIME ===")
-        print(f"🌐 URL: {main_url}")
-        print(f"🔑 Headers: {headers}")
+        print(f"🌐 URL: {client.url}")
         
         # Test plusieurs endpoints
         endpoints = [
@@ -609,10 +483,10 @@ def debug_biotime_raw_data():
         
         for endpoint in endpoints:
             print(f"\n📡 Test endpoint: {endpoint}")
-            url = f"{main_url}{endpoint}?page_size=2"
+            url = f"{endpoint}?page_size=2"
             
             try:
-                response = requests.get(url, headers=headers, timeout=10)
+                response = client.get(url, timeout=10)
                 print(f"   Status: {response.status_code}")
                 
                 if response.ok:
@@ -630,21 +504,23 @@ def debug_biotime_raw_data():
             except Exception as e:
                 print(f"   Exception: {str(e)}")
         
-        # Test récupération employés complet
-        print(f"\n👥 === TEST RÉCUPÉRATION EMPLOYÉS COMPLET ===")
-        employees = fetch_all_biotime_employees(headers, main_url)
+        # Employés: miroir local (BioTime Employee), sans re-paginer toute l'API
+        print(f"\n👥 === MIROIR EMPLOYÉS BIOTIME ===")
+        employees_count = frappe.db.count("BioTime Employee")
+        last_refresh = frappe.db.sql("SELECT MAX(modified) FROM `tabBioTime Employee`")[0][0]
+        print(f"✅ Total employés dans le miroir: {employees_count} (dernière mise à jour: {last_refresh or 'jamais'})")
         
-        if employees:
-            print(f"✅ Total employés récupérés: {len(employees)}")
+        employees = frappe.get_all("BioTime Employee", pluck="payload", order_by="name asc", limit_page_length=1)
+        if employees and employees[0]:
             print(f"📋 Structure premier employé:")
-            emp_example = employees[0]
+            emp_example = json.loads(employees[0])
             for key, value in emp_example.items():
                 print(f"   {key}: {value}")
         
         return {
             "status": "success", 
             "message": "Débogage terminé, vérifiez la console du serveur",
-            "employees_count": len(employees) if employees else 0
+            "employees_count": employees_count
         }
         
     except Exception as e:
@@ -674,7 +550,7 @@ def test_authentication_only():
         print(f"🔑 Password length: {len(doc.get_password('password') or '')}")
         print(f"📤 Données envoyées: {json.dumps(data, indent=2)}")
         
-        response = requests.post(url, data=json.dumps(data), headers=headers, timeout=10)
+        response = get_client().post(url, auth=False, max_retries=0, data=json.dumps(data), headers=headers, timeout=10)
         
         print(f"📡 Status Code: {response.status_code}")
         print(f"📡 Headers réponse: {dict(response.headers)}")
@@ -727,7 +603,7 @@ def diagnose_biotime_auth_issue():
         # Test 2: URL de base accessible ?
         print("\n🌐 Test 2: Accessibilité serveur...")
         try:
-            base_response = requests.get(doc.url, timeout=5)
+            base_response = get_client().get(doc.url, auth=False, max_retries=0, timeout=5)
             print(f"   Status: {base_response.status_code}")
             print(f"   Serveur: {base_response.headers.get('Server', 'Unknown')}")
         except Exception as e:
@@ -753,7 +629,7 @@ def diagnose_biotime_auth_issue():
             }
             
             try:
-                resp = requests.get(test_url, headers=headers, timeout=5)
+                resp = get_client().get(test_url, auth=False, max_retries=0, headers=headers, timeout=5)
                 print(f"   {name}: Status {resp.status_code}")
                 
                 if resp.ok:
@@ -785,7 +661,7 @@ def diagnose_biotime_auth_issue():
         for endpoint in endpoints:
             url = doc.url + endpoint
             try:
-                resp = requests.get(url + '?page_size=1', headers=headers, timeout=5)
+                resp = get_client().get(url + '?page_size=1', auth=False, max_retries=0, headers=headers, timeout=5)
                 print(f"   {endpoint}: Status {resp.status_code}")
                 
                 if resp.ok:
@@ -803,14 +679,14 @@ def diagnose_biotime_auth_issue():
             
             # Test GET (lecture)
             try:
-                get_resp = requests.get(url + '?page_size=1', headers=headers, timeout=5)
+                get_resp = get_client().get(url + '?page_size=1', auth=False, max_retries=0, headers=headers, timeout=5)
                 print(f"   GET permissions: {get_resp.status_code}")
             except:
                 print("   GET permissions: Erreur")
             
             # Test OPTIONS (métadonnées)
             try:
-                options_resp = requests.options(url, headers=headers, timeout=5)
+                options_resp = get_client().options(url, auth=False, max_retries=0, headers=headers, timeout=5)
                 print(f"   OPTIONS permissions: {options_resp.status_code}")
                 allowed = options_resp.headers.get('Allow', 'Non spécifié')
                 print(f"   Méthodes autorisées: {allowed}")
@@ -860,7 +736,7 @@ def comprehensive_auth_test():
         # ✅ Test 2: Test de connectivité de base
         print("\n🌐 Test de connectivité de base...")
         try:
-            ping_response = requests.get(doc.url, timeout=5)
+            ping_response = get_client().get(doc.url, auth=False, max_retries=0, timeout=5)
             print(f"   Ping Status: {ping_response.status_code}")
             print(f"   Ping Response: {ping_response.text[:200]}...")
         except Exception as e:
@@ -886,7 +762,7 @@ def comprehensive_auth_test():
             
             print(f"\n📡 Test format {i+1}: {format_name}")
             try:
-                resp = requests.get(test_url, headers=headers, timeout=5)
+                resp = get_client().get(test_url, auth=False, max_retries=0, headers=headers, timeout=5)
                 print(f"   Status: {resp.status_code}")
                 print(f"   Response: {resp.text[:150]}...")
                 
@@ -912,7 +788,7 @@ def comprehensive_auth_test():
             print(f"📡 Test: {endpoint}")
             
             try:
-                resp = requests.get(url, headers=headers, timeout=5)
+                resp = get_client().get(url, auth=False, max_retries=0, headers=headers, timeout=5)
                 print(f"   Status: {resp.status_code}")
                 if resp.ok:
                     print(f"   ✅ Endpoint fonctionnel: {endpoint}")
@@ -925,248 +801,119 @@ def comprehensive_auth_test():
         print(f"❌ Exception test auth: {str(e)}")
         return {"status": "error", "message": str(e)}
 
-def get_tokan():
-    """Récupère un token depuis BioTime selon la documentation officielle"""
-    doc = frappe.get_single("BioTime Setting")
-    # ✅ CORRECTION: Endpoint correct selon la documentation
-    url = doc.url + "/api-token-auth/"
-    headers = {
-        "Content-Type": "application/json",
-    }
-    data = {
-        "username": doc.user_name,
-        "password": doc.get_password('password')
-    }
-    
-    print(f"🔐 Récupération token depuis: {url}")
-    print(f"👤 Username: {doc.user_name}")
-    print(f"🔑 Password fourni: {'✅ Oui' if doc.get_password('password') else '❌ Non'}")
-    print(f"📤 Données envoyées: {json.dumps(data, indent=2)}")
-    
-    try:
-        response = requests.post(url, data=json.dumps(data), headers=headers, timeout=10)
-        
-        print(f"📡 Status Code: {response.status_code}")
-        print(f"📡 Response: {response.text}")
-        
-        if response.ok:
-            response_data = response.json()
-            print(f"📋 Structure réponse: {response_data}")
-            
-            # ✅ CORRECTION: Selon la doc, le token est dans {"token": "..."}
-            token = response_data.get("token")
-            
-            if token:
-                print(f"✅ Token récupéré avec succès: {token[:20]}...")
-                return token
-            else:
-                print(f"❌ Pas de token dans la réponse: {response_data}")
-                frappe.throw(
-                    title='Erreur Token',
-                    msg=f'Token non trouvé. Structure: {response_data}',
-                )
-        else:
-            print(f"❌ Erreur HTTP {response.status_code}: {response.text}")
-            frappe.throw(
-                title='Erreur Authentification',
-                msg=f'Erreur {response.status_code}: Vérifiez vos identifiants BioTime',
-            )
-            
-    except requests.exceptions.RequestException as e:
-        print(f"❌ Erreur réseau: {str(e)}")
-        frappe.log_error(
-            message=f"Erreur réseau lors de l'authentification: {str(e)}", 
-            title="Erreur Connexion BioTime"
-        )
-        frappe.throw(
-            title='Erreur Connexion',
-            msg='Impossible de se connecter au serveur BioTime. Vérifiez l\'URL.',
-        )
-    except Exception as e:
-        print(f"❌ Erreur générale: {str(e)}")
-        frappe.log_error(
-            message=f"Erreur lors de la récupération du token: {str(e)}", 
-            title="Erreur Token BioTime"
-        )
-        frappe.throw(
-            title='Erreur',
-            msg='Échec de récupération du token. Vérifiez vos paramètres.',
-        )
-    
-
-
 def get_url():
     doc = frappe.get_single("BioTime Setting")
     url = doc.url
     return url
 
-def get_auth_headers():
-    """Retourne les headers d'authentification selon la documentation officielle"""
-    token = get_tokan()
-    
-    if not token:
-        print("❌ Impossible de récupérer le token")
-        return None
-        
-    print(f"🔑 Token obtenu: {token[:20]}...")
-    
-    # 🧪 Test de plusieurs formats d'Authorization selon la documentation
-    doc = frappe.get_single("BioTime Setting")
-    test_url = f"{doc.url}/personnel/api/employees/?page_size=1"
-    
-    headers_to_test = [
-        {'Authorization': f'JWT {token}', 'Content-Type': 'application/json'},  # Format actuel
-        {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'},  # Format Bearer
-        {'Authorization': f'Token {token}', 'Content-Type': 'application/json'},  # Format Token
-        {'Authorization': token, 'Content-Type': 'application/json'},  # Token seul
-    ]
-    
-    for i, headers in enumerate(headers_to_test):
-        format_name = headers['Authorization'].split(' ')[0] if ' ' in headers['Authorization'] else 'Token seul'
-        print(f"🧪 Test format {i+1}: {format_name}")
-        
-        try:
-            test_response = requests.get(test_url, headers=headers, timeout=5)
-            print(f"   Status: {test_response.status_code}")
-            
-            if test_response.ok:
-                print(f"✅ Format fonctionnel trouvé: {format_name}")
-                return headers  # Retourner le format qui fonctionne
-            elif test_response.status_code != 401:
-                print(f"   Réponse non-401: {test_response.text[:100]}")
-                
-        except Exception as e:
-            print(f"   Erreur: {str(e)[:50]}")
-    
-    print("⚠️ Aucun format d'Authorization fonctionnel trouvé, utilisation JWT par défaut")
-    return {
-        'Content-Type': 'application/json',
-        'Authorization': 'JWT ' + token
-    }
-
 @frappe.whitelist()
 def fetch_transactions():
-    main_url = get_url()
-    headers = get_auth_headers()
+    start_date, end_date = get_month_range(today())
+    fetch_transactions_for_period(start_date, end_date)
 
-    transactions_list = []
-
-    start_date = get_first_day(today()).strftime("%Y-%m-%d %H:%M:%S")
-    end_date = get_last_day(today()).strftime("%Y-%m-%d %H:%M:%S")
+def get_month_range(date):
+    """Début du mois → lendemain du dernier jour"""
+    start_date = get_first_day(date).strftime("%Y-%m-%d %H:%M:%S")
+    end_date = get_last_day(date).strftime("%Y-%m-%d %H:%M:%S")
     end_date = add_to_date(end_date, days=1)
-    is_next_page = True
-    url = f"{main_url}/iclock/api/transactions/?start_time={start_date}&end_time={end_date}"
+    return start_date, end_date
 
-    progress_count = 0
-    count = 0
-    while is_next_page:
-        try:
-            response = requests.request("GET", url, headers=headers)
-            if response.ok:
-                res = json.loads(response.text)
-                transactions = res.get("data")
-                # print(res)
-                count = res.get("count")
-                if not res.get("next"):
-                    is_next_page = False
-                else:
-                    for transaction in transactions:
-                        transactions_list.append(transaction)
-                url = res.get("next")
-            else:
-                is_next_page = False
-                frappe.log_error(message=res.get("detail", ""),
-                                 title=f"Failed to Get Transactions")
+def get_period_params(start_date, end_date):
+    return {
+        "start_time": start_date,
+        "end_time": end_date,
+        "page_size": 100,
+        "ordering": "id"
+    }
 
-        except Exception as e:
-            is_next_page = False
-            frappe.log_error(
-                message=e, title="Failed while fetching transactions")
-            frappe.publish_realtime("msgprint", "Can't Fetch Transactions please check your tokan or url <hr> For more details review error log")
-    
-    is_next_page = True
-    while is_next_page:
+def fetch_transactions_for_period(start_date, end_date):
+    """Récupère et intègre les transactions d'une période, page par page"""
+    params = get_period_params(start_date, end_date)
+    try:
+        handel_transaction_pages(stream_transaction_pages(params))
+    except Exception as e:
+        frappe.log_error(
+            message=e, title="Failed while fetching transactions")
+        frappe.publish_realtime("msgprint", "Can't Fetch Transactions please check your tokan or url <hr> For more details review error log")
 
-        try:
-            response = requests.request("GET", url, headers=headers)
-            if response.ok:
-                res = json.loads(response.text)
-                transactions = res.get("data")
-                # print(res)
-                count = res.get("count")
-                if res.get("next"):
-                    is_next_page = False
-                else:
-                    for transaction in transactions:
-                        transactions_list.append(transaction)
-                url = res.get("next")
-            else:
-                is_next_page = False
-                frappe.log_error(message=res.get("detail", ""),
-                                 title=f"Failed to Get Transactions")
+def stream_transaction_pages(params):
+    """Pages de transactions BioTime, récupérées en arrière-plan pendant l'écriture des check-ins"""
+    client = get_client()
+    settings = frappe.get_single("BioTime Setting")
+    concurrency = cint(settings.fetch_concurrency) or 1
+    queue_size = cint(settings.pipeline_queue_size) or 4
+    
+    pages = client.iter_pages("/iclock/api/transactions/", params, concurrency)
+    return client.prefetch(pages, queue_size)
 
-        except Exception as e:
-            is_next_page = False
-            frappe.log_error(
-                message=e, title="Failed while fetching transactions")
-            frappe.publish_realtime("msgprint", "Can't Fetch Transactions please check your tokan or url <hr> For more details review error log")
+def handel_transactions(transactions):
+    handel_transaction_pages([{"count": len(transactions), "data": transactions}])
 
-        progress_count += 10
-        publish_progress(progress_count*100/int(count + 1),
-                         title="Fetching Transactions...")
+def new_transaction_stats():
+    return frappe._dict(total=0, processed=0, exists=0, created=0, errors=0, unmatched=0)
 
-    if len(transactions_list):
+def handel_transaction_pages(pages, stats=None, finish=True):
+    """Intègre les transactions au fil des pages reçues (mémoire constante)
+    
+    finish=False: pas de rapport ni de mise à jour des Shift Type (shard d'une sync distribuée).
+    """
+    stats = stats or new_transaction_stats()
+    writer = CheckinWriter()
+    employees = EmployeeMap()
+    unmatched = UnmatchedPunches()
+    progress = ProgressReporter(title="Creating Employee Checkin...")
+    try:
+        for page in pages:
+            stats.total = stats.total or cint(page.get("count"))
+            transactions = page.get("data") or []
+            # Une seule requête Employee pour les codes de la page
+            employees.load(t.get("emp_code") for t in transactions)
+            for transaction in transactions:
+                handel_transaction(transaction, stats, writer, employees, unmatched)
+                stats.processed += 1
+                progress.update(stats.processed, stats.total)
+    finally:
+        writer_stats = writer.close()
+        stats.created += writer_stats.created
+        stats.exists += writer_stats.duplicates
+        stats.errors += writer_stats.errors
+        # Codes inconnus: un enregistrement récapitulatif par emp_code, pas un message par pointage
+        unmatched.save()
+        stats.unmatched += unmatched.count
+        progress.finish()
+        if finish:
+            finish_transactions(stats)
+    return stats
 
-        handel_transactions(transactions_list)
+def handel_transaction(transaction, stats, writer, employees, unmatched):
+    # Les transactions déjà présentes sont écartées par le writer (une requête par lot)
+    # Check if employee exists
+    employee = employees.get(transaction.get("emp_code"))
+    if employee:
+        # Create Transaction (ajout au lot, écriture groupée)
+        if not create_employee_checkin(transaction, writer, employee):
+            stats.errors += 1
+    else:
+        # Employee with this code Not in System: regroupé dans Unmatched BioTime Punch,
+        # conservé pour rejeu une fois l'employé créé
+        unmatched.add(transaction)
+        writer.failed.add(transaction, get_unmatched_reason(transaction))
 
-def handel_transactions(transactions):
-    exists_trans = 0
-    progress_count = 0
-    created = 0
-    errors = 0
-    for transaction in transactions:
-        
-        # Check if Transaction is Exists
-        is_exists = frappe.db.exists(
-            {"doctype": "Employee Checkin", "transaction_id": transaction.get("id")})
-        if is_exists:
-            exists_trans += 1
-        else:
-            # Check if employee exists
-            is_emp_exists = frappe.db.exists(
-                {"doctype": "Employee", "attendance_device_id": transaction.get("emp_code")})
-            if is_emp_exists:
-                # Create Transaction
-                new_trans = create_employee_checkin(transaction)
-                if new_trans:
-                    created += 1
-                else:
-                    errors += 1
-            else:
-                trans_no = transaction.get("id")
-                emp_code = transaction.get("emp_code")         
-                errors += 1
-                frappe.msgprint(
-                    msg=_(f"Can't Create Transaction No. { str(trans_no) } because Employee with code { emp_code } Not in System, Please make sure to Fetching Employees"),
-                    title=_("Transaction Creation Faild"),
-                )
-        progress_count += 1
+def finish_transactions(stats, user=None):
+    msg = "Try to Create {} Employee Checkin: <br> {} already Exists In System  <br> {} Successfully Created ,<br> {} Failed <hr> for more details about Failed Employee Checkin Docs review errors log".format(
+        stats.processed, stats.exists, stats.created, stats.errors)
+    if stats.unmatched:
+        msg += get_unmatched_message(stats.unmatched)
+    # last_sync_of_checkin: mis à jour par le writer, uniquement pour les Shift Type des check-ins créés
+    frappe.publish_realtime('msgprint', msg, user=user)
 
-        publish_progress(int(progress_count * 100/len(transactions)),
-                         title="Creating Employee Checkin...")
+def get_unmatched_reason(transaction):
+    return f"Aucun employé actif avec attendance_device_id = {transaction.get('emp_code')}"
 
-    msg = "Try to Create {} Employee Checkin: <br> {} already Exists In System  <br> {} Successfully Created ,<br> {} Failed <hr> for more details about Failed Employee Checkin Docs review errors log".format(
-        len(transactions), exists_trans, created, errors)
-    if created >0:
-        shift_list =  frappe.get_list("Shift Type" , filters = {"enable_auto_attendance" : 1})
-        for shift in shift_list:
-            shift_doc = frappe.get_doc("Shift Type" , shift)
-            shift_doc.last_sync_of_checkin = datetime.now()
-            shift_doc.save()
-            frappe.db.commit()
-    frappe.publish_realtime('msgprint', msg)
+def get_unmatched_message(count):
+    return _("<hr> {0} punches have an Employee code Not in System, see <a href='/app/unmatched-biotime-punch'>Unmatched BioTime Punch</a> and make sure to Fetching Employees").format(count)
     
-def create_employee_checkin(transaction):
+def create_employee_checkin(transaction, writer, employee):
     res = False
     if transaction:
         try:
@@ -1178,20 +925,12 @@ def create_employee_checkin(transaction):
             else:
                 log_type = ""
 
-            employee = frappe.db.get_list(
-                "Employee", filters={"attendance_device_id": transaction.get("emp_code")})
-            doc = frappe.new_doc('Employee Checkin')
-            doc.employee = employee[0].name
-            doc.time = transaction.get("punch_time")
-            doc.log_type = log_type
-            doc.transaction_id = transaction.get("id")
-            doc.save()
+            writer.add(employee.name, transaction.get("punch_time"), log_type, transaction,
+                       employee_name=employee.employee_name, default_shift=employee.default_shift)
             res = True
-            frappe.db.commit()
         except Exception as e:
-            trans_no = transaction.get("id")
-            frappe.log_error(
-                message=e, title=f"Failed to Create Employee With id <b> {trans_no} <b>")
+            # Conservée brute dans BioTime Failed Transaction pour rejeu
+            writer.failed.add(transaction, e)
             res = False
     return res
 
@@ -1202,84 +941,10 @@ def create_employee_checkin(transaction):
 
 @frappe.whitelist()
 def fetch():
-    main_url = get_url()
-    headers = get_auth_headers()
-
-    transactions_list = []
     date = frappe.get_single("BioTime Setting").date
-    print("DDDDDDDDDDDDDDDDDDDD" , date)
-    start_date = get_first_day(date).strftime("%Y-%m-%d %H:%M:%S")
-    end_date = get_last_day(date).strftime("%Y-%m-%d %H:%M:%S")
-    end_date = add_to_date(end_date, days=1)
-    print("DDDDDDDDDDDDDDDDDDDD" , start_date, end_date)
-
-    is_next_page = True
-    url = f"{main_url}/iclock/api/transactions/?start_time={start_date}&end_time={end_date}"
-
-    progress_count = 0
-    count = 0
-    is_next_page = True
-    while is_next_page:
-
-        try:
-            response = requests.request("GET", url, headers=headers)
-            if response.ok:
-                res = json.loads(response.text)
-                transactions = res.get("data")
-                # print(res)
-                count = res.get("count")
-                if not res.get("next"):
-                    is_next_page = False
-                else:
-                    for transaction in transactions:
-                        transactions_list.append(transaction)
-                url = res.get("next")
-            else:
-                is_next_page = False
-                frappe.log_error(message=res.get("detail", ""),
-                                 title=f"Failed to Get Transactions")
-
-        except Exception as e:
-            is_next_page = False
-            frappe.log_error(
-                message=e, title="Failed while fetching transactions")
-            frappe.publish_realtime("msgprint", "Can't Fetch Transactions please check your tokan or url <hr> For more details review error log")
-    is_next_page = True
-    while is_next_page:
-
-        try:
-            response = requests.request("GET", url, headers=headers)
-            if response.ok:
-                res = json.loads(response.text)
-                transactions = res.get("data")
-                # print(res)
-                count = res.get("count")
-                if res.get("next"):
-                    is_next_page = False
-                else:
-                    for transaction in transactions:
-                        transactions_list.append(transaction)
-                url = res.get("next")
-            else:
-                is_next_page = False
-                frappe.log_error(message=res.get("detail", ""),
-                                 title=f"Failed to Get Transactions")
-
-        except Exception as e:
-            is_next_page = False
-            frappe.log_error(
-                message=e, title="Failed while fetching transactions")
-            frappe.publish_realtime("msgprint", "Can't Fetch Transactions please check your tokan or url <hr> For more details review error log")
-
-        progress_count += 10
-        publish_progress(progress_count*100/int(count + 1),
-                         title="Fetching Transactions...")
-        progress_count += 10
-        publish_progress(progress_count*100/int(count + 1),
-                         title="Fetching Transactions...")
-    print(len(transactions_list))
-    if len(transactions_list):
-        handel_transactions(transactions_list)
+    start_date, end_date = get_month_range(date)
+    print(f"📅 Période: {start_date} → {end_date}")
+    fetch_transactions_for_period(start_date, end_date)
 
 @frappe.whitelist()
 def fetch_biotime_transactions(start_date=None, end_date=None, emp_code=None):
@@ -1295,64 +960,59 @@ def fetch_biotime_transactions(start_date=None, end_date=None, emp_code=None):
             
         print(f"📅 Période: {start_date} → {end_date}")
         
-        headers = get_auth_headers()
-        main_url = get_url()
-        
-        if not headers:
-            return {"error": "❌ Impossible d'obtenir les headers d'authentification"}
-        
-        # Construire l'URL avec paramètres
-        url = f"{main_url}/iclock/api/transactions/"
+        # Paramètres de la requête
         params = {
             "page_size": 100,
             "start_time": start_date,
-            "end_time": end_date
+            "end_time": end_date,
+            # Ordre stable: les nouveaux pointages n'affectent pas les pages déjà calculées
+            "ordering": "id"
         }
         
         if emp_code:
             params["emp_code"] = emp_code
             
-        print(f"🌐 URL: {url}")
         print(f"📋 Paramètres: {params}")
         
-        all_transactions = []
-        page = 1
+        fetched = created = skipped = 0
+        # Un seul writer pour toutes les pages: un commit tous les N check-ins
+        writer = CheckinWriter()
+        unmatched = UnmatchedPunches()
+        progress = ProgressReporter(title="Creating Employee Checkin...")
         
-        while True:
-            params["page"] = page
-            print(f"📄 Traitement page {page}...")
-            
-            response = requests.get(url, headers=headers, params=params, timeout=30)
-            
-            if response.ok:
-                data = response.json()
+        # Chaque page est écrite dès réception, pendant que les suivantes se téléchargent
+        try:
+            for page, data in enumerate(stream_transaction_pages(params), 1):
                 transactions = data.get("data", [])
+                print(f"📄 Page {page}: {len(transactions)} transactions trouvées")
                 
-                print(f"   📊 {len(transactions)} transactions trouvées")
-                all_transactions.extend(transactions)
-                
-                # Vérifier s'il y a une page suivante
-                if not data.get("next"):
-                    print("✅ Dernière page atteinte")
-                    break
-                    
-                page += 1
-                
-            else:
-                print(f"❌ Erreur HTTP {response.status_code}: {response.text}")
-                break
-        
-        print(f"✅ Total transactions récupérées: {len(all_transactions)}")
-        
-        # Créer les Employee Check-ins
-        if all_transactions:
-            result = create_employee_checkins(all_transactions)
+                if transactions:
+                    result = create_employee_checkins(transactions, writer, unmatched)
+                    fetched += len(transactions)
+                    skipped += result["skipped"]
+                progress.update(fetched, cint(data.get("count")))
+        except requests.HTTPError as e:
+            print(f"❌ Erreur HTTP {e.response.status_code}: {e.response.text}")
+        finally:
+            progress.finish()
+            writer_stats = writer.close()
+            created += writer_stats.created
+            skipped += writer_stats.duplicates + writer_stats.errors
+            unmatched.save()
+        
+        print(f"✅ Total transactions récupérées: {fetched}")
+        
+        if fetched:
+            message = f"Récupéré {fetched} transactions, créé {created} check-ins"
+            if unmatched.count:
+                message += get_unmatched_message(unmatched.count)
             return {
                 "status": "success",
-                "transactions_count": len(all_transactions),
-                "checkins_created": result["created"],
-                "checkins_skipped": result["skipped"],
-                "message": f"Récupéré {len(all_transactions)} transactions, créé {result['created']} check-ins"
+                "transactions_count": fetched,
+                "checkins_created": created,
+                "checkins_skipped": skipped,
+                "unmatched_count": unmatched.count,
+                "message": message
             }
         else:
             return {
@@ -1366,10 +1026,30 @@ def fetch_biotime_transactions(start_date=None, end_date=None, emp_code=None):
         frappe.log_error(message=str(e), title="Erreur Récupération Transactions BioTime")
         return {"error": error_msg}
 
-def create_employee_checkins(transactions):
-    """Crée des Employee Check-in depuis les transactions BioTime"""
+def create_employee_checkins(transactions, writer=None, unmatched=None):
+    """Crée des Employee Check-in depuis les transactions BioTime
+    
+    Avec un writer partagé, les check-ins restent dans son lot courant: l'appelant
+    le ferme et ajoute ses compteurs (created n'inclut alors que les lots déjà écrits).
+    Les pointages sans employé sont ajoutés à unmatched (enregistré par l'appelant).
+    """
     created_count = 0
     skipped_count = 0
+    own_writer = writer is None
+    if own_writer:
+        writer = CheckinWriter()
+    
+    # Employés actifs des codes présents: une requête pour tout le lot
+    employees = EmployeeMap()
+    employees.load(t.get("emp_code") for t in transactions)
+    
+    meta = frappe.get_meta("Employee Checkin")
+    custom_fields = {
+        fieldname for fieldname in (
+            "custom_biotime_transaction_id", "custom_punch_state", "custom_verify_type",
+            "custom_gps_location", "custom_temperature"
+        ) if meta.has_field(fieldname)
+    }
     
     print("📝 === CRÉATION EMPLOYEE CHECK-INS ===")
     
@@ -1386,18 +1066,17 @@ def create_employee_checkins(transactions):
                 continue
             
             # Trouver l'employé ERPNext correspondant
-            employee = frappe.db.get_value(
-                "Employee",
-                {"attendance_device_id": emp_code, "status": "Active"},
-                ["name", "employee_name"]
-            )
+            employee = employees.get(emp_code, active_only=True)
             
             if not employee:
-                print(f"⚠️ Employé non trouvé pour emp_code: {emp_code}")
+                # Code inconnu (et non simple employé inactif): récapitulatif par emp_code
+                if unmatched is not None and not employees.get(emp_code):
+                    unmatched.add(transaction)
+                writer.failed.add(transaction, get_unmatched_reason(transaction))
                 skipped_count += 1
                 continue
             
-            employee_name, employee_full_name = employee
+            employee_name, employee_full_name = employee.name, employee.employee_name
             
             # Convertir punch_state en log_type ERPNext
             if punch_state == "0" or "check in" in punch_state_display.lower():
@@ -1410,76 +1089,50 @@ def create_employee_checkins(transactions):
             # Convertir le format de date
             punch_datetime = frappe.utils.get_datetime(punch_time)
             
-            # Vérifier si ce check-in existe déjà (éviter les doublons)
-            existing_checkin = frappe.db.exists(
-                "Employee Checkin",
-                {
-                    "employee": employee_name,
-                    "time": punch_datetime,
-                    "log_type": log_type
-                }
-            )
-            
-            if existing_checkin:
-                print(f"⚠️ Check-in déjà existant: {employee_full_name} - {punch_time}")
-                skipped_count += 1
-                continue
-            
-            # Créer l'Employee Checkin
-            checkin_doc = frappe.new_doc("Employee Checkin")
-            checkin_doc.employee = employee_name
-            checkin_doc.log_type = log_type
-            checkin_doc.time = punch_datetime
-            checkin_doc.device_id = transaction.get("terminal_sn", "BioTime")
-            
-            # Informations supplémentaires dans des champs personnalisés
-            # Note: Ces champs devront être ajoutés au DocType Employee Checkin si souhaités
-            try:
-                if hasattr(checkin_doc, 'custom_biotime_transaction_id'):
-                    checkin_doc.custom_biotime_transaction_id = str(transaction.get("id"))
-                if hasattr(checkin_doc, 'custom_punch_state'):
-                    checkin_doc.custom_punch_state = punch_state_display
-                if hasattr(checkin_doc, 'custom_verify_type'):
-                    checkin_doc.custom_verify_type = transaction.get("verify_type_display", "")
-                if hasattr(checkin_doc, 'custom_gps_location') and transaction.get("gps_location"):
-                    checkin_doc.custom_gps_location = transaction.get("gps_location")
-                if hasattr(checkin_doc, 'custom_temperature') and transaction.get("temperature"):
-                    checkin_doc.custom_temperature = transaction.get("temperature")
-            except:
-                pass  # Ignorer si les champs personnalisés n'existent pas
-            
-            checkin_doc.save()
-            created_count += 1
+            # Les doublons (transaction_id ou employé/heure/type) sont écartés par lot dans le writer
+            # Informations supplémentaires dans des champs personnalisés (si présents)
+            extra = {}
+            if "custom_biotime_transaction_id" in custom_fields:
+                extra["custom_biotime_transaction_id"] = str(transaction.get("id"))
+            if "custom_punch_state" in custom_fields:
+                extra["custom_punch_state"] = punch_state_display
+            if "custom_verify_type" in custom_fields:
+                extra["custom_verify_type"] = transaction.get("verify_type_display", "")
+            if "custom_gps_location" in custom_fields and transaction.get("gps_location"):
+                extra["custom_gps_location"] = transaction.get("gps_location")
+            if "custom_temperature" in custom_fields and transaction.get("temperature"):
+                extra["custom_temperature"] = transaction.get("temperature")
             
-            print(f"✅ Check-in créé: {employee_full_name} - {log_type} - {punch_time}")
+            # Ajout au lot: insertion groupée et un commit par lot
+            writer.add(
+                employee_name,
+                punch_datetime,
+                log_type,
+                transaction,
+                employee_name=employee_full_name,
+                device_id=transaction.get("terminal_sn", "BioTime"),
+                extra=extra,
+                default_shift=employee.default_shift,
+            )
             
         except Exception as e:
             print(f"❌ Erreur création check-in: {str(e)}")
             skipped_count += 1
-            frappe.log_error(
-                message=f"Erreur check-in pour transaction {transaction.get('id')}: {str(e)}",
-                title="Erreur Création Employee Checkin"
-            )
+            writer.failed.add(transaction, e)
     
-    frappe.db.commit()
-    print(f"📊 Résumé: {created_count} créés, {skipped_count} ignorés")
+    if own_writer:
+        writer_stats = writer.close()
+        created_count = writer_stats.created
+        skipped_count += writer_stats.duplicates + writer_stats.errors
+        print(f"📊 Résumé: {created_count} créés, {skipped_count} ignorés")
     
     return {"created": created_count, "skipped": skipped_count}
 
 @frappe.whitelist()
 def sync_transactions_scheduled():
-    """Fonction appelée par le job schedulé pour synchroniser les transactions"""
+    """Fonction appelée par le job schedulé: synchronisation incrémentale depuis le curseur"""
     try:
-        # Récupérer les transactions des dernières 30 minutes (avec marge)
-        start_time = frappe.utils.add_to_date(frappe.utils.now(), minutes=-30)
-        end_time = frappe.utils.now()
-        
-        print(f"🕒 Synchronisation programmée: {start_time} → {end_time}")
-        
-        result = fetch_biotime_transactions(
-            start_date=start_time.strftime('%Y-%m-%d %H:%M:%S'),
-            end_date=end_time.strftime('%Y-%m-%d %H:%M:%S')
-        )
+        result = sync_transactions_incremental()
         
         print(f"✅ Sync programmée terminée: {result.get('message', 'OK')}")
         return result
@@ -1491,6 +1144,152 @@ def sync_transactions_scheduled():
         )
         print(f"❌ Erreur sync programmée: {str(e)}")
 
+def sync_transactions_incremental():
+    """Récupère uniquement les transactions au-delà du curseur (id / upload_time) et l'avance page par page
+    
+    Les pointages sont seulement mis en file (BioTime Transaction): la création des
+    Employee Checkin est faite par le job biotime.tasks.materialize_transactions.
+    """
+    cursor = get_sync_cursor()
+    params = get_cursor_params(cursor)
+    
+    print(f"🕒 Synchronisation incrémentale depuis la transaction {cursor.transaction_id} ({cursor.upload_time or 'début'})")
+    
+    start_id = cursor.transaction_id
+    fetched = staged = 0
+    # Le curseur n'avance page par page que si BioTime respecte l'ordre croissant des id
+    ascending = True
+    completed = False
+    
+    progress = ProgressReporter(title="Syncing BioTime Transactions...")
+    try:
+        for data in stream_transaction_pages(params):
+            # Filtre local: l'API peut ignorer les filtres qu'elle ne connaît pas
+            transactions = [t for t in data.get("data", []) if cint(t.get("id")) > start_id]
+            
+            ids = [cint(t.get("id")) for t in transactions]
+            if ids != sorted(ids) or (ids and ids[0] <= cursor.transaction_id):
+                ascending = False
+            
+            page_cursor = advance_sync_cursor(cursor, transactions)
+            
+            if transactions:
+                fetched += len(transactions)
+                # Insertion brute commitée: point de reprise du curseur
+                staged += stage_transactions(transactions)
+            
+            cursor = page_cursor
+            if ascending:
+                save_sync_cursor(cursor)
+            progress.update(fetched, cint(data.get("count")))
+        
+        completed = True
+    except requests.HTTPError as e:
+        frappe.log_error(
+            message=f"{e.response.status_code} - {e.response.text}",
+            title="Erreur Sync Incrémentale Transactions"
+        )
+    finally:
+        progress.finish()
+        if staged:
+            frappe.enqueue("biotime.tasks.materialize_transactions", queue="long")
+    
+    # Toutes les pages traitées: le curseur couvre aussi les transactions déjà en file
+    if completed and not ascending:
+        save_sync_cursor(cursor)
+    
+    return {
+        "status": "success" if completed else "error",
+        "transactions_count": fetched,
+        "staged_count": staged,
+        "message": f"Récupéré {fetched} nouvelles transactions, {staged} mises en file pour création des check-ins"
+    }
+
+def get_sync_cursor():
+    """Curseur persistant: plus grand id et upload_time de transaction déjà intégrés"""
+    return frappe._dict(
+        transaction_id=cint(frappe.db.get_single_value("BioTime Setting", "last_transaction_id")),
+        upload_time=frappe.db.get_single_value("BioTime Setting", "last_upload_time"),
+    )
+
+def advance_sync_cursor(cursor, transactions):
+    """Nouveau curseur après intégration des transactions (ne recule jamais)"""
+    cursor = frappe._dict(cursor)
+    for transaction in transactions:
+        cursor.transaction_id = max(cursor.transaction_id, cint(transaction.get("id")))
+        upload_time = transaction.get("upload_time")
+        if upload_time and (not cursor.upload_time or get_datetime(upload_time) > get_datetime(cursor.upload_time)):
+            cursor.upload_time = get_datetime(upload_time)
+    return cursor
+
+def save_sync_cursor(cursor):
+    """Enregistre le curseur une fois les check-ins de la page commités"""
+    frappe.db.set_single_value("BioTime Setting", {
+        "last_transaction_id": cursor.transaction_id,
+        "last_upload_time": cursor.upload_time,
+    })
+    frappe.db.commit()
+
+# Support du filtre id__gt, sondé puis mémorisé un jour (une sonde et au plus une alerte par jour)
+CURSOR_FILTER_CACHE_KEY = "biotime:cursor_id_filter"
+CURSOR_FILTER_CHECK_TTL = 24 * 3600
+
+def get_cursor_params(cursor):
+    """Paramètres API pour ne demander que les transactions plus récentes que le curseur
+    
+    Si BioTime ignore id__gt, la fenêtre cursor_lookback_days est conservée (les terminaux
+    hors ligne remontent tard des pointages anciens) et le filtre id est appliqué localement:
+    chaque passage relit alors toute la fenêtre, coût signalé dans l'Error Log.
+    """
+    params = {"page_size": 100, "ordering": "id"}
+    
+    # Borne punch_time: les terminaux hors ligne envoient tard des pointages plus anciens
+    if cursor.upload_time:
+        lookback = cint(frappe.db.get_single_value("BioTime Setting", "cursor_lookback_days")) or 31
+        start_time = add_to_date(cursor.upload_time, days=-lookback)
+    else:
+        start_time = get_first_day(today())
+    params["start_time"] = get_datetime(start_time).strftime("%Y-%m-%d %H:%M:%S")
+    
+    if cursor.transaction_id:
+        params["id__gt"] = cursor.transaction_id
+        if not is_cursor_filter_supported(params, cursor):
+            params.pop("id__gt")
+    
+    return params
+
+def is_cursor_filter_supported(params, cursor):
+    """Sonde d'une transaction: BioTime applique-t-il id__gt? (résultat mémorisé)"""
+    cache = frappe.cache()
+    known = cache.get_value(CURSOR_FILTER_CACHE_KEY)
+    if known:
+        return known == "supported"
+    
+    try:
+        first = get_client().get_page("/iclock/api/transactions/", dict(params, page_size=1), 1)
+    except requests.HTTPError:
+        # Indéterminé: la synchronisation rapportera l'erreur, nouvelle sonde au prochain passage
+        return True
+    
+    rows = first.get("data") or []
+    if not rows:
+        # Rien après le curseur: conclusion impossible, nouvelle sonde au prochain passage
+        return True
+    
+    supported = cint(rows[0].get("id")) > cursor.transaction_id
+    cache.set_value(CURSOR_FILTER_CACHE_KEY, "supported" if supported else "ignored", expires_in_sec=CURSOR_FILTER_CHECK_TTL)
+    if not supported:
+        frappe.log_error(
+            message=(
+                f"id__gt={cursor.transaction_id} ignoré (transaction {rows[0].get('id')} retournée, "
+                f"{first.get('count')} transactions dans la fenêtre): chaque synchronisation relit toute la "
+                f"fenêtre cursor_lookback_days et filtre les id localement. Réduire cursor_lookback_days "
+                f"limite ce coût, au risque de manquer des pointages remontés tardivement."
+            ),
+            title="Sync Incrémentale: filtre id__gt non supporté"
+        )
+    return supported
+
 @frappe.whitelist()
 def create_employee_from_discovery_wrapper(discovery_name):
     """Wrapper pour créer un employé depuis Employee Discovery"""
@@ -0,0 +1,20 @@
+// Copyright (c) 2026, ARD and contributors
+// For license information, please see license.txt
+
+frappe.listview_settings['BioTime Employee'] = {
+	onload: function(listview) {
+		listview.page.add_inner_button(__('Refresh from BioTime'), function() {
+			frappe.call({
+				method: 'biotime.mirror.enqueue_employee_mirror_refresh',
+				args: {
+					'full': 1
+				},
+				callback: function(r) {
+					if (r.message) {
+						frappe.show_alert({message: r.message.message, indicator: 'blue'});
+					}
+				}
+			});
+		});
+	}
+};
@@ -0,0 +1,20 @@
+// Copyright (c) 2026, ARD and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on('BioTime Failed Transaction', {
+	refresh: function(frm) {
+		frm.add_custom_button(__('Replay'), function() {
+			frappe.call({
+				method: 'biotime.tasks.enqueue_replay_failed_transactions',
+				args: {
+					'emp_code': frm.doc.emp_code
+				},
+				callback: function(r) {
+					if (r.message) {
+						frappe.show_alert({message: r.message.message, indicator: 'blue'});
+					}
+				}
+			});
+		});
+	}
+});
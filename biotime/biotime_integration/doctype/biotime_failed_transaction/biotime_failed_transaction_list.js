@@ -0,0 +1,17 @@
+// Copyright (c) 2026, ARD and contributors
+// For license information, please see license.txt
+
+frappe.listview_settings['BioTime Failed Transaction'] = {
+	onload: function(listview) {
+		listview.page.add_inner_button(__('Replay All'), function() {
+			frappe.call({
+				method: 'biotime.tasks.enqueue_replay_failed_transactions',
+				callback: function(r) {
+					if (r.message) {
+						frappe.show_alert({message: r.message.message, indicator: 'blue'});
+					}
+				}
+			});
+		});
+	}
+};
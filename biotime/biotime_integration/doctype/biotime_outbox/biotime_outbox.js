@@ -0,0 +1,8 @@
+// Copyright (c) 2026, ARD and contributors
+// For license information, please see license.txt
+
+// frappe.ui.form.on('BioTime Outbox', {
+// 	refresh: function(frm) {
+
+// 	}
+// });
@@ -0,0 +1,18 @@
+// Copyright (c) 2026, ARD and contributors
+// For license information, please see license.txt
+
+frappe.listview_settings['BioTime Outbox'] = {
+	onload: function(listview) {
+		listview.page.add_inner_button(__('Retry Failed'), function() {
+			frappe.call({
+				method: 'biotime.outbox.retry_failed_outbox',
+				callback: function(r) {
+					if (r.message) {
+						frappe.show_alert({message: r.message.message, indicator: 'blue'});
+						listview.refresh();
+					}
+				}
+			});
+		});
+	}
+};
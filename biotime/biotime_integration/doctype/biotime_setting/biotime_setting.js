@@ -7,9 +7,11 @@ frappe.ui.form.on('BioTime Setting', {
 			method: "enqueue_long_job_fetch_transactions",
 			doc: frm.doc,
 			callback: function (r) {
-				if (!r.exc) {
-					console.log("Fetch transactions completed");
-					frappe.msgprint("✅ Transactions synchronisées avec succès");
+				if (!r.exc && r.message) {
+					frappe.show_alert({
+						message: r.message.message,
+						indicator: 'blue'
+					});
 				}
 			},
 		});
@@ -20,8 +22,11 @@ frappe.ui.form.on('BioTime Setting', {
 			method: "enqueue_long_job_fetch",
 			doc: frm.doc,
 			callback: function (r) {
-				if (!r.exc) {
-					console.log("Custom fetch completed");
+				if (!r.exc && r.message) {
+					frappe.show_alert({
+						message: r.message.message,
+						indicator: 'blue'
+					});
 				}
 			},
 		});
@@ -140,6 +145,20 @@ frappe.ui.form.on('BioTime Setting', {
 		});
 	},
 
+	refresh_reference_data: function (frm) {
+		frappe.call({
+			method: "biotime.reference.refresh_reference_data",
+			callback: function (r) {
+				if (!r.exc && r.message) {
+					frappe.show_alert({
+						message: r.message.message,
+						indicator: 'green'
+					});
+				}
+			},
+		});
+	},
+
 	sync_transactions: function (frm) {
 		// Créer un dialogue pour sélectionner la période
 		let dialog = new frappe.ui.Dialog({
@@ -3,20 +3,39 @@
 # Updated: 2025-11-11 - Force module reload
 
 import frappe
-import requests
 import json
 from frappe.model.document import Document
-from frappe import enqueue
-from biotime.api import fetch_transactions, fetch, discover_biotime_employees, sync_erpnext_employees_to_biotime, get_tokan, get_url, debug_biotime_raw_data, test_authentication_only, diagnose_biotime_auth_issue, fetch_biotime_transactions
+from frappe.utils import today
+from biotime.api import fetch_transactions, discover_biotime_employees, sync_erpnext_employees_to_biotime, debug_biotime_raw_data, test_authentication_only, diagnose_biotime_auth_issue, fetch_biotime_transactions, get_month_range
+from biotime.client import clear_token_cache, clear_client_cache, get_client
+from biotime.tasks import enqueue_transaction_sync
+from biotime.reference import clear_reference_cache
+
+# Au-delà, la synchronisation vers BioTime part en arrière-plan
+PUSH_INLINE_LIMIT = 50
 
 
 class BioTimeSetting(Document):
     
+    def on_update(self):
+        """Invalide le token partagé, le pool HTTP et les références (URL ou identifiants potentiellement modifiés)"""
+        clear_token_cache()
+        clear_client_cache()
+        clear_reference_cache()
+    
     @frappe.whitelist()
     def enqueue_long_job_fetch_transactions(self):
-        """Synchronise les transactions BioTime vers ERPNext"""
-        fetch_transactions()
-        return {"status": "success", "message": "Transactions synchronisées"}
+        """Synchronise les transactions du mois courant en arrière-plan (shards répartis sur les workers)"""
+        return self.enqueue_month_sync(today())
+    
+    def enqueue_month_sync(self, date):
+        start_date, end_date = get_month_range(date)
+        sync = enqueue_transaction_sync(start_date, end_date)
+        return {
+            "status": "queued",
+            "sync_id": sync.sync_id,
+            "message": f"Synchronisation {start_date} → {end_date} lancée en arrière-plan ({sync.shards} tâches). Un rapport s'affichera à la fin."
+        }
     
     @frappe.whitelist()
     def sync_transactions_with_daterange(self, start_date, end_date, emp_code=None):
@@ -108,8 +127,8 @@ class BioTimeSetting(Document):
     
     @frappe.whitelist()
     def enqueue_long_job_fetch(self):
-        # enqueue('biotime.api.fetch_transactions', queue="long", timeout=3600)
-        fetch()
+        """Synchronise le mois de la date choisie en arrière-plan"""
+        return self.enqueue_month_sync(self.date)
     
     @frappe.whitelist()
     def discover_employees(self):
@@ -137,6 +156,21 @@ class BioTimeSetting(Document):
     @frappe.whitelist()
     def sync_to_biotime(self):
         """Synchronise les employés ERPNext vers BioTime"""
+        pending = frappe.db.count("Employee", [["status", "=", "Active"], ["attendance_device_id", "in", [None, ""]]])
+        if pending > PUSH_INLINE_LIMIT:
+            # Gros volume: exécution sur la file 'long', résumé envoyé à la fin
+            frappe.enqueue(
+                "biotime.api.sync_erpnext_employees_to_biotime",
+                queue="long",
+                timeout=3600,
+                user=frappe.session.user,
+            )
+            frappe.msgprint(
+                f"Synchronisation de {pending} employés lancée en arrière-plan",
+                title="Synchronisation BioTime",
+                indicator="blue"
+            )
+            return
         result = sync_erpnext_employees_to_biotime()
         if result.get("status") == "success":
             frappe.msgprint(
@@ -161,12 +195,11 @@ class BioTimeSetting(Document):
         """Teste la connexion avec BioTime"""
         try:
             print("🔍 Test de connexion BioTime...")
-            from biotime.api import get_auth_headers
-            headers = get_auth_headers()
-            main_url = get_url()
+            client = get_client()
+            main_url = client.url
             
             # Test simple: récupérer les infos du serveur
-            response = requests.get(f"{main_url}/personnel/api/employees/?page_size=1", headers=headers, timeout=10)
+            response = client.get("/personnel/api/employees/?page_size=1", timeout=10)
             
             if response.ok:
                 data = response.json()
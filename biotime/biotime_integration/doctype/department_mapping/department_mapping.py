@@ -4,6 +4,7 @@
 import frappe
 from frappe.model.document import Document
 from frappe import _
+from biotime.matching import get_department_index
 
 class DepartmentMapping(Document):
 	def validate(self):
@@ -44,11 +45,8 @@ def get_mapping_for_department(biotime_dept):
 @frappe.whitelist()
 def create_auto_mappings():
 	"""Crée des mappings automatiques basés sur les noms similaires"""
-	# Récupérer tous les départements ERPNext
-	erpnext_departments = frappe.get_all(
-		"Department", 
-		fields=["name", "department_name"]
-	)
+	# Index des départements ERPNext (token/trigramme), construit une fois
+	erpnext_departments = get_department_index()
 	
 	# Récupérer les départements BioTime depuis Employee Discovery
 	biotime_departments = frappe.db.sql("""
@@ -62,31 +60,26 @@ def create_auto_mappings():
 		)
 	""", as_dict=True)
 	
-	created_count = 0
-	
+	# Meilleur candidat au-dessus du score minimal pour chaque département BioTime
+	mappings = []
 	for biotime_dept in biotime_departments:
-		dept_name = biotime_dept.department
-		
-		# Chercher un département ERPNext similaire
-		matched_dept = None
-		for erpnext_dept in erpnext_departments:
-			if (dept_name.lower() in erpnext_dept.department_name.lower() or
-				erpnext_dept.department_name.lower() in dept_name.lower()):
-				matched_dept = erpnext_dept.name
-				break
-		
-		# Créer le mapping si trouvé
+		matched_dept = erpnext_departments.best(biotime_dept.department)
 		if matched_dept:
-			try:
-				mapping_doc = frappe.new_doc("Department Mapping")
-				mapping_doc.biotime_department = dept_name
-				mapping_doc.erpnext_department = matched_dept
-				mapping_doc.save()
-				created_count += 1
-			except Exception as e:
-				frappe.log_error(f"Erreur création mapping: {e}")
+			mappings.append((biotime_dept.department, matched_dept))
+	
+	# Créer les mappings trouvés en une insertion groupée
+	if mappings:
+		timestamp = frappe.utils.now()
+		user = frappe.session.user
+		frappe.db.bulk_insert(
+			"Department Mapping",
+			["name", "biotime_department", "erpnext_department", "owner", "modified_by", "creation", "modified", "docstatus"],
+			[[dept_name, dept_name, matched_dept, user, user, timestamp, timestamp, 0] for dept_name, matched_dept in mappings],
+			ignore_duplicates=True
+		)
+		frappe.db.commit()
 	
 	return {
-		"created_count": created_count,
+		"created_count": len(mappings),
 		"total_biotime_departments": len(biotime_departments)
-	}
\ No newline at end of file
+	}
@@ -46,6 +46,24 @@ frappe.ui.form.on('Employee Discovery', {
             }, __('Actions')).addClass('btn-primary');
         }
         
+        // Fiche BioTime brute chargée à la demande depuis le miroir
+        if (frm.doc.biotime_employee) {
+            frm.add_custom_button(__('BioTime Data'), function() {
+                frappe.call({
+                    method: "get_biotime_payload",
+                    doc: frm.doc,
+                    callback: function(r) {
+                        frappe.msgprint({
+                            title: __('BioTime Data'),
+                            message: r.message
+                                ? '<pre>' + frappe.utils.escape_html(JSON.stringify(r.message, null, 2)) + '</pre>'
+                                : __('Not found in the BioTime Employee mirror')
+                        });
+                    }
+                });
+            });
+        }
+        
         // Bouton de rejet toujours disponible
         if (frm.doc.status !== "Employee Created" && frm.doc.status !== "Rejected") {
             frm.add_custom_button(__('Reject'), function() {
@@ -5,6 +5,17 @@ import frappe
 import json
 from frappe.model.document import Document
 from frappe import _
+from biotime.matching import get_department_index, get_designation_index
+from biotime.mirror import get_mirror_payload
+from biotime.ingestion import get_commit_every
+from biotime.utils import ProgressReporter, bulk_set_values, bulk_update_column
+
+# Colonnes lues pour créer un Employee
+DISCOVERY_EMPLOYEE_FIELDS = [
+    "name", "device_id", "employee_name", "first_name", "last_name", "department", "gender",
+    "date_of_birth", "date_of_joining", "personal_email", "mobile", "office_tel",
+    "mapped_department", "mapped_designation", "default_shift_type", "employment_type"
+]
 
 class EmployeeDiscovery(Document):
     
@@ -21,75 +32,11 @@ class EmployeeDiscovery(Document):
             frappe.throw(_("L'employé doit être validé avant création"))
         
         try:
-            # Récupérer les données BioTime
-            biotime_data = json.loads(self.biotime_data) if self.biotime_data else {}
-            
-            # Créer le nouvel employé
-            employee_doc = frappe.new_doc('Employee')
-            
-            # Champs obligatoires avec valeurs par défaut
-            employee_doc.employee_name = self.employee_name or "Employé BioTime"
-            employee_doc.attendance_device_id = self.device_id
-            employee_doc.status = 'Active'
-            
-            # First name - priorité: first_name du form, sinon extraire du employee_name, sinon "Employé"
-            if self.first_name:
-                employee_doc.first_name = self.first_name
-            elif self.employee_name:
-                name_parts = self.employee_name.split()
-                employee_doc.first_name = name_parts[0] if name_parts else "Employé"
-            else:
-                employee_doc.first_name = "Employé"
-            
-            # Last name - optionnel
-            if self.last_name:
-                employee_doc.last_name = self.last_name
-            elif self.employee_name and len(self.employee_name.split()) > 1:
-                name_parts = self.employee_name.split()
-                employee_doc.last_name = " ".join(name_parts[1:])
-            
-            # Gender - valeur par défaut "Male"
-            employee_doc.gender = self.gender or "Male"
-            
-            # Date of Birth - valeur par défaut 01/01/1980
-            if self.date_of_birth:
-                employee_doc.date_of_birth = self.date_of_birth
-            else:
-                employee_doc.date_of_birth = "1980-01-01"
-            
-            # Date of Joining - valeur par défaut aujourd'hui
-            if self.date_of_joining:
-                employee_doc.date_of_joining = self.date_of_joining
-            else:
-                employee_doc.date_of_joining = frappe.utils.today()
-            
-            # Mapping des champs
-            if self.mapped_department:
-                employee_doc.department = self.mapped_department
-            if self.mapped_designation:
-                employee_doc.designation = self.mapped_designation
-            if self.employment_type:
-                employee_doc.employment_type = self.employment_type
-            if self.default_shift_type:
-                employee_doc.default_shift = self.default_shift_type
-            
-            # Email personnel si disponible
-            if self.personal_email:
-                employee_doc.personal_email = self.personal_email
-            
-            # Données supplémentaires depuis BioTime
-            if biotime_data:
-                employee_doc.employee_number = biotime_data.get('emp_code')
-                if biotime_data.get('email') and not self.personal_email:
-                    employee_doc.personal_email = biotime_data.get('email')
-                if biotime_data.get('mobile'):
-                    employee_doc.cell_number = biotime_data.get('mobile')
-                if biotime_data.get('office_tel'):
-                    employee_doc.company_email = biotime_data.get('office_tel')
-            
-            # Générer le nom d'employé
-            employee_doc.naming_series = "EMP-.YYYY.-"
-            
+            mapping = frappe.db.get_value(
+                "Department Mapping", {"biotime_department": self.department},
+                ["erpnext_department", "default_designation", "default_shift_type"], as_dict=True
+            ) if self.department else None
+            employee_doc = make_employee_doc(self, mapping)
             employee_doc.save()
             
             # Mettre à jour le statut de découverte
@@ -97,6 +44,14 @@ class EmployeeDiscovery(Document):
             self.notes = f"Employé créé: {employee_doc.name}"
             self.save()
             
+            # Pointages de ce badge mis en attente faute d'employé: rejeu en arrière-plan
+            frappe.enqueue(
+                "biotime.tasks.replay_failed_transactions",
+                queue="long",
+                emp_codes=[self.device_id],
+                enqueue_after_commit=True,
+            )
+            
             frappe.msgprint(
                 _("Employé créé avec succès: {0}").format(employee_doc.name),
                 title=_("Succès"),
@@ -112,6 +67,11 @@ class EmployeeDiscovery(Document):
             )
             frappe.throw(_("Erreur lors de la création de l'employé: {0}").format(str(e)))
     
+    @frappe.whitelist()
+    def get_biotime_payload(self):
+        """Fiche BioTime brute, lue à la demande depuis le miroir"""
+        return get_mirror_payload(self.biotime_employee or self.device_id)
+    
     @frappe.whitelist()
     def reject_discovery(self):
         """Rejette la découverte d'employé"""
@@ -131,6 +91,25 @@ class EmployeeDiscovery(Document):
 @frappe.whitelist()
 def bulk_validate_employees(discovery_names, action="validate"):
     """Validation en masse des employés découverts"""
+    if isinstance(discovery_names, str):
+        discovery_names = json.loads(discovery_names)
+    
+    if action == "create":
+        # Création groupée en arrière-plan: un seul résumé à la fin
+        frappe.enqueue(
+            "biotime.biotime_integration.doctype.employee_discovery.employee_discovery.create_employees_from_discoveries",
+            queue="long",
+            timeout=3600,
+            discovery_names=discovery_names,
+            user=frappe.session.user,
+        )
+        return {
+            "status": "queued",
+            "success": 0,
+            "failed": 0,
+            "messages": [_("Création de {0} employés lancée en arrière-plan").format(len(discovery_names))]
+        }
+    
     results = {"success": 0, "failed": 0, "messages": []}
     
     for name in discovery_names:
@@ -145,56 +124,185 @@ def bulk_validate_employees(discovery_names, action="validate"):
             elif action == "reject":
                 doc.reject_discovery()
                 results["success"] += 1
-            elif action == "create":
-                if doc.status == "Validated":
-                    doc.create_employee_from_discovery()
-                    results["success"] += 1
-                else:
-                    results["messages"].append(f"{name}: Doit être validé d'abord")
-                    results["failed"] += 1
         except Exception as e:
             results["failed"] += 1
             results["messages"].append(f"{name}: {str(e)}")
     
     return results
 
+def create_employees_from_discoveries(discovery_names=None, user=None):
+    """Crée les employés des découvertes validées par lots (un commit par lot, un seul résumé)"""
+    filters = {"status": "Validated"}
+    if discovery_names is not None:
+        filters["name"] = ["in", discovery_names]
+    discoveries = frappe.get_all("Employee Discovery", filters=filters, fields=DISCOVERY_EMPLOYEE_FIELDS, order_by="name asc")
+    
+    # Références chargées une fois: Department Mapping et badges déjà attribués
+    mappings = {
+        mapping.biotime_department: mapping
+        for mapping in frappe.get_all(
+            "Department Mapping",
+            fields=["biotime_department", "erpnext_department", "default_designation", "default_shift_type"]
+        )
+    }
+    existing = set(frappe.get_all("Employee", filters={"attendance_device_id": ["is", "set"]}, pluck="attendance_device_id"))
+    
+    stats = frappe._dict(created=0, failed=0, skipped=0)
+    created_codes = []
+    errors = []
+    batch_size = get_commit_every()
+    progress = ProgressReporter(title="Creating Employees from Discoveries...", total=len(discoveries))
+    
+    for start in range(0, len(discoveries), batch_size):
+        notes = {}
+        for discovery in discoveries[start:start + batch_size]:
+            progress.update()
+            if discovery.device_id in existing:
+                stats.skipped += 1
+                continue
+            
+            frappe.db.savepoint("discovery_employee")
+            try:
+                employee_doc = make_employee_doc(discovery, mappings.get(discovery.department))
+                employee_doc.insert()
+            except Exception as e:
+                # Seule cette ligne est annulée, le reste du lot continue
+                frappe.db.rollback(save_point="discovery_employee")
+                frappe.clear_messages()
+                stats.failed += 1
+                errors.append(f"{discovery.name}: {str(e)}")
+                continue
+            
+            existing.add(discovery.device_id)
+            created_codes.append(discovery.device_id)
+            notes[discovery.name] = f"Employé créé: {employee_doc.name}"
+            stats.created += 1
+        
+        if notes:
+            bulk_set_values("Employee Discovery", {name: {"status": "Employee Created"} for name in notes})
+            bulk_update_column("Employee Discovery", "notes", notes)
+        frappe.db.commit()
+    
+    progress.finish()
+    
+    if errors:
+        frappe.log_error(message="\n".join(errors), title=f"Erreur création employés ({len(errors)} découvertes)")
+    
+    if created_codes:
+        # Pointages en attente de ces badges: un seul rejeu
+        frappe.enqueue("biotime.tasks.replay_failed_transactions", queue="long", emp_codes=created_codes)
+    
+    message = _("Création terminée: {0} employés créés, {1} échecs, {2} déjà existants").format(
+        stats.created, stats.failed, stats.skipped)
+    if user:
+        frappe.publish_realtime("msgprint", message, user=user)
+    return {"status": "success", "message": message, **stats}
+
+def make_employee_doc(discovery, mapping=None):
+    """Nouvel Employee (non enregistré) depuis une découverte et son Department Mapping éventuel"""
+    mapping = mapping or {}
+    
+    # Créer le nouvel employé
+    employee_doc = frappe.new_doc('Employee')
+    
+    # Champs obligatoires avec valeurs par défaut
+    employee_doc.employee_name = discovery.employee_name or "Employé BioTime"
+    employee_doc.attendance_device_id = discovery.device_id
+    employee_doc.status = 'Active'
+    
+    # First name - priorité: first_name du form, sinon extraire du employee_name, sinon "Employé"
+    if discovery.first_name:
+        employee_doc.first_name = discovery.first_name
+    elif discovery.employee_name:
+        name_parts = discovery.employee_name.split()
+        employee_doc.first_name = name_parts[0] if name_parts else "Employé"
+    else:
+        employee_doc.first_name = "Employé"
+    
+    # Last name - optionnel
+    if discovery.last_name:
+        employee_doc.last_name = discovery.last_name
+    elif discovery.employee_name and len(discovery.employee_name.split()) > 1:
+        name_parts = discovery.employee_name.split()
+        employee_doc.last_name = " ".join(name_parts[1:])
+    
+    # Gender - valeur par défaut "Male"
+    employee_doc.gender = discovery.gender or "Male"
+    
+    # Date of Birth - valeur par défaut 01/01/1980
+    employee_doc.date_of_birth = discovery.date_of_birth or "1980-01-01"
+    
+    # Date of Joining - valeur par défaut aujourd'hui
+    employee_doc.date_of_joining = discovery.date_of_joining or frappe.utils.today()
+    
+    # Mapping des champs (sinon valeurs par défaut du Department Mapping)
+    department = discovery.mapped_department or mapping.get("erpnext_department")
+    designation = discovery.mapped_designation or mapping.get("default_designation")
+    shift_type = discovery.default_shift_type or mapping.get("default_shift_type")
+    if department:
+        employee_doc.department = department
+    if designation:
+        employee_doc.designation = designation
+    if discovery.employment_type:
+        employee_doc.employment_type = discovery.employment_type
+    if shift_type:
+        employee_doc.default_shift = shift_type
+    
+    # Email personnel si disponible
+    if discovery.personal_email:
+        employee_doc.personal_email = discovery.personal_email
+    
+    # Données supplémentaires depuis BioTime (colonnes de la découverte)
+    employee_doc.employee_number = discovery.device_id
+    if discovery.mobile:
+        employee_doc.cell_number = discovery.mobile
+    if discovery.office_tel:
+        employee_doc.company_email = discovery.office_tel
+    
+    # Générer le nom d'employé
+    employee_doc.naming_series = "EMP-.YYYY.-"
+    # Déjà à jour dans BioTime: pas de ligne BioTime Outbox
+    employee_doc.flags.from_biotime = True
+    return employee_doc
+
 @frappe.whitelist()
 def auto_map_departments_and_designations():
-    """Mapping automatique basé sur les noms similaires"""
+    """Mapping automatique basé sur les noms similaires (index token/trigramme, écriture groupée)"""
     discoveries = frappe.get_all(
         "Employee Discovery", 
         filters={"status": "Pending Validation"},
-        fields=["name", "department", "position"]
+        fields=["name", "department", "position", "mapped_department", "mapped_designation"]
     )
     
-    # Récupérer départements et désignations ERPNext
-    departments = frappe.get_all("Department", fields=["name", "department_name"])
-    designations = frappe.get_all("Designation", fields=["name", "designation_name"])
-    
-    mapped_count = 0
+    # Index des départements et désignations ERPNext: construits une fois pour tout le run
+    departments = get_department_index()
+    designations = get_designation_index()
+    # Mappings explicites (Department Mapping) prioritaires sur le rapprochement par nom
+    department_mappings = dict(frappe.get_all(
+        "Department Mapping", fields=["biotime_department", "erpnext_department"], as_list=True
+    ))
     
+    updates = {}
     for discovery in discoveries:
-        doc = frappe.get_doc("Employee Discovery", discovery.name)
+        values = {}
         
         # Mapping département (recherche par similarité)
-        if discovery.department and not doc.mapped_department:
-            for dept in departments:
-                if (discovery.department.lower() in dept.department_name.lower() or
-                    dept.department_name.lower() in discovery.department.lower()):
-                    doc.mapped_department = dept.name
-                    break
+        if discovery.department and not discovery.mapped_department:
+            department = department_mappings.get(discovery.department) or departments.best(discovery.department)
+            if department:
+                values["mapped_department"] = department
         
         # Mapping désignation
-        if discovery.position and not doc.mapped_designation:
-            for desig in designations:
-                if (discovery.position.lower() in desig.designation_name.lower() or
-                    desig.designation_name.lower() in discovery.position.lower()):
-                    doc.mapped_designation = desig.name
-                    break
+        if discovery.position and not discovery.mapped_designation:
+            designation = designations.best(discovery.position)
+            if designation:
+                values["mapped_designation"] = designation
         
-        # Sauvegarder si des mappings ont été trouvés
-        if doc.mapped_department or doc.mapped_designation:
-            doc.save()
-            mapped_count += 1
+        if values:
+            updates[discovery.name] = values
+    
+    # Sauvegarder les mappings trouvés: une requête par valeur distincte
+    bulk_set_values("Employee Discovery", updates)
+    frappe.db.commit()
     
-    return {"mapped_count": mapped_count, "total_discoveries": len(discoveries)}
\ No newline at end of file
+    return {"mapped_count": len(updates), "total_discoveries": len(discoveries)}
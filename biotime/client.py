@@ -0,0 +1,491 @@
+import frappe
+import json
+import math
+import time
+import queue
+import base64
+import random
+import requests
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+# Cache partagé (Redis) du token BioTime pour tous les workers du site
+TOKEN_CACHE_KEY = "biotime:token"
+TOKEN_LOCK_KEY = "biotime:token_lock"
+# Durée de vie par défaut si le token n'est pas un JWT (ou sans claim exp)
+DEFAULT_TOKEN_TTL = 30 * 60
+# Renouvellement anticipé avant l'expiration réelle du token
+TOKEN_REFRESH_MARGIN = 60
+
+# Schéma Authorization fonctionnel, mémorisé par URL BioTime
+AUTH_SCHEME_CACHE_KEY = "biotime:auth_scheme"
+# Ordre de test des formats ("" = token seul, sans préfixe)
+AUTH_SCHEMES = ("JWT", "Bearer", "Token", "")
+DEFAULT_AUTH_SCHEME = "JWT"
+
+# Valeurs par défaut si non renseignées dans BioTime Setting
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = 30
+DEFAULT_MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.5
+BACKOFF_MAX = 30
+# Méthodes rejouables sans risque de doublon côté BioTime
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+
+# Un client (et donc un pool de connexions) par site et par processus
+_clients = {}
+
+
+class BioTimeClient:
+    """Client HTTP BioTime: session poolée (keep-alive), timeouts, retries et ré-authentification"""
+
+    def __init__(self, url, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT, max_retries=DEFAULT_MAX_RETRIES):
+        self.url = (url or "").rstrip("/")
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.headers = None
+        # Instant (time.time) à partir duquel les headers doivent être relus (renouvellement du token)
+        self.headers_expiry = 0
+        # Délégation de la ré-authentification depuis un thread producteur (voir prefetch)
+        self._local = threading.local()
+
+        self.session = requests.Session()
+        # Les retries sont gérés ici (backoff + 401), pas par urllib3
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def build_url(self, path):
+        """Accepte un chemin relatif (/iclock/api/...) ou une URL complète (lien "next")"""
+        if path.startswith("http://") or path.startswith("https://"):
+            return path
+        return self.url + path
+
+    def get_headers(self):
+        """Headers mémorisés jusqu'au renouvellement prévu du token partagé, puis relus depuis le cache
+
+        Hors contexte frappe (threads d'un pool), les headers mémorisés restent utilisés:
+        un 401 éventuel est traité par l'appelant.
+        """
+        if not self.headers or (time.time() >= self.headers_expiry and getattr(frappe.local, "site", None)):
+            self.resolve_headers()
+        return self.headers
+
+    def resolve_headers(self):
+        self.headers = get_auth_headers()
+        token = get_tokan() if self.headers else None
+        self.headers_expiry = time.time() + max(get_token_ttl(token), 0) if token else 0
+
+    def reauthenticate(self):
+        """Récupère un nouveau token (et redécouvre le schéma si nécessaire)"""
+        stale_headers = self.headers
+        self.resolve_headers()
+        # Un autre worker a peut-être déjà renouvelé le token partagé
+        if self.headers == stale_headers:
+            reset_auth()
+            self.resolve_headers()
+
+    def request(self, method, path, auth=True, reauth=True, headers=None, timeout=None, max_retries=None, **kwargs):
+        """Requête avec backoff exponentiel (5xx, erreurs réseau) et un seul retry après 401"""
+        method = method.upper()
+        url = self.build_url(path)
+        max_retries = self.max_retries if max_retries is None else max_retries
+        attempt = 0
+        reauthenticated = False
+
+        while True:
+            request_headers = dict(self.get_headers() or {}) if auth else {}
+            if headers:
+                request_headers.update(headers)
+
+            try:
+                response = self.session.request(
+                    method, url, headers=request_headers, timeout=timeout or self.timeout, **kwargs
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                # Un timeout de lecture sur un POST a pu être traité par BioTime: ne pas rejouer
+                retryable = isinstance(e, requests.ConnectionError) or method in IDEMPOTENT_METHODS
+                if not retryable or attempt >= max_retries:
+                    raise
+                attempt += 1
+                print(f"⚠️ {method} {url}: {str(e)[:80]} - retry {attempt}/{max_retries}")
+                self.backoff(attempt)
+                continue
+
+            if response.status_code == 401 and auth and reauth and not reauthenticated:
+                print(f"🔄 401 sur {method} {url}: ré-authentification")
+                delegate = getattr(self._local, "reauth_delegate", None)
+                (delegate or self.reauthenticate)()
+                reauthenticated = True
+                continue
+
+            if response.status_code >= 500 and method in IDEMPOTENT_METHODS and attempt < max_retries:
+                attempt += 1
+                print(f"⚠️ {method} {url}: HTTP {response.status_code} - retry {attempt}/{max_retries}")
+                self.backoff(attempt)
+                continue
+
+            return response
+
+    def prefetch(self, pages, queue_size=4):
+        """Exécute un itérateur de pages dans un thread producteur, via une file bornée.
+
+        Le réseau avance pendant que l'appelant écrit en base, sans jamais avoir plus
+        de `queue_size` pages en attente. La ré-authentification a besoin du contexte
+        frappe: un 401 côté producteur est délégué au thread appelant, puis rejoué.
+        """
+        pages_queue = queue.Queue(maxsize=max(1, int(queue_size or 1)))
+        auth_done = threading.Event()
+        stopped = threading.Event()
+
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    pages_queue.put(item, timeout=1)
+                    return
+                except queue.Full:
+                    continue
+
+        def delegate_reauth():
+            auth_done.clear()
+            put(("auth", None))
+            while not stopped.is_set() and not auth_done.wait(timeout=1):
+                pass
+
+        def produce():
+            self._local.reauth_delegate = delegate_reauth
+            try:
+                for page in pages:
+                    if stopped.is_set():
+                        return
+                    put(("page", page))
+                put(("done", None))
+            except BaseException as e:
+                put(("error", e))
+
+        # Headers résolus ici: le producteur ne doit pas toucher au contexte frappe
+        self.get_headers()
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+
+        try:
+            while True:
+                kind, value = pages_queue.get()
+                if kind == "page":
+                    yield value
+                elif kind == "auth":
+                    try:
+                        self.reauthenticate()
+                    finally:
+                        auth_done.set()
+                elif kind == "error":
+                    raise value
+                else:
+                    return
+        finally:
+            stopped.set()
+
+    def backoff(self, attempt):
+        """Attente exponentielle avec jitter complet"""
+        delay = min(BACKOFF_MAX, BACKOFF_FACTOR * 2 ** (attempt - 1))
+        time.sleep(random.uniform(0, delay))
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def get_page(self, path, params, page, reauth=True):
+        """Récupère une page (pagination page=N) et retourne le JSON, HTTPError sinon"""
+        response = self.get(path, params=dict(params, page=page), reauth=reauth)
+        response.raise_for_status()
+        return response.json()
+
+    def iter_pages(self, path, params=None, concurrency=1):
+        """Parcourt une liste paginée et retourne les pages dans l'ordre.
+
+        La page 1 donne "count", donc le nombre total de pages: les suivantes sont
+        demandées en parallèle, avec au plus `concurrency` requêtes en vol.
+        """
+        params = dict(params or {})
+        first = self.get_page(path, params, 1)
+        yield first
+
+        rows = first.get("data") or []
+        page_size = int(params.get("page_size") or len(rows) or 1)
+        total_pages = math.ceil(int(first.get("count") or 0) / page_size)
+        if not first.get("next") or total_pages <= 1:
+            return
+
+        concurrency = max(1, min(int(concurrency or 1), self.pool_size))
+        if concurrency == 1:
+            for page in range(2, total_pages + 1):
+                yield self.get_page(path, params, page)
+            return
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            pending = deque()
+            next_page = 2
+            while next_page <= total_pages or pending:
+                # Fenêtre bornée: les pages en avance ne s'accumulent pas en mémoire
+                while next_page <= total_pages and len(pending) < concurrency * 2:
+                    # Pas de ré-authentification dans les threads (contexte frappe absent)
+                    future = executor.submit(self.get_page, path, params, next_page, False)
+                    pending.append((next_page, future))
+                    next_page += 1
+
+                page, future = pending.popleft()
+                try:
+                    yield future.result()
+                except (requests.HTTPError, requests.ConnectionError, requests.Timeout) as e:
+                    # Ex: 401 dans un thread: nouvel essai ici, avec ré-authentification
+                    print(f"⚠️ Page {page}: {str(e)[:80]} - nouvel essai")
+                    yield self.get_page(path, params, page)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def options(self, path, **kwargs):
+        return self.request("OPTIONS", path, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+def get_client():
+    """Retourne le client BioTime du site, recréé si la configuration a changé"""
+    doc = frappe.get_single("BioTime Setting")
+    config = (
+        doc.url,
+        doc.get("http_pool_size") or DEFAULT_POOL_SIZE,
+        doc.get("http_timeout") or DEFAULT_TIMEOUT,
+        doc.get("http_max_retries") or DEFAULT_MAX_RETRIES,
+    )
+
+    site = frappe.local.site
+    cached = _clients.get(site)
+    if cached and cached[0] == config:
+        return cached[1]
+
+    if cached:
+        cached[1].close()
+
+    client = BioTimeClient(*config)
+    _clients[site] = (config, client)
+    return client
+
+
+def clear_client_cache():
+    """Ferme le client du site courant (nouvelle configuration au prochain appel)"""
+    cached = _clients.pop(frappe.local.site, None)
+    if cached:
+        cached[1].close()
+
+
+def get_tokan(force_refresh=False):
+    """Retourne le token BioTime depuis le cache partagé, ou en demande un nouveau"""
+    cache = frappe.cache()
+
+    if not force_refresh:
+        token = cache.get_value(TOKEN_CACHE_KEY)
+        if token:
+            return token
+
+    # Un seul worker se connecte à la fois: évite les rafales de login au démarrage
+    lock = cache.lock(cache.make_key(TOKEN_LOCK_KEY), timeout=30, blocking_timeout=15)
+    acquired = False
+    try:
+        acquired = lock.acquire()
+        if not force_refresh:
+            token = cache.get_value(TOKEN_CACHE_KEY)
+            if token:
+                return token
+
+        token = request_token()
+        ttl = get_token_ttl(token)
+        if ttl > 0:
+            cache.set_value(TOKEN_CACHE_KEY, token, expires_in_sec=ttl)
+        return token
+    finally:
+        if acquired:
+            try:
+                lock.release()
+            except Exception:
+                # Verrou expiré entre-temps: rien à libérer
+                pass
+
+
+def clear_token_cache():
+    """Invalide le token BioTime partagé"""
+    frappe.cache().delete_value(TOKEN_CACHE_KEY)
+
+
+def get_auth_headers():
+    """Retourne les headers d'authentification avec le schéma mémorisé pour cette URL"""
+    token = get_tokan()
+
+    if not token:
+        print("❌ Impossible de récupérer le token")
+        return None
+
+    scheme = get_auth_scheme(token)
+    return build_auth_headers(token, scheme)
+
+
+def build_auth_headers(token, scheme):
+    """Construit les headers pour un schéma donné"""
+    return {
+        'Authorization': f'{scheme} {token}' if scheme else token,
+        'Content-Type': 'application/json'
+    }
+
+
+def get_auth_scheme(token):
+    """Schéma Authorization accepté par le serveur, découvert une seule fois par URL"""
+    url = frappe.get_single("BioTime Setting").url
+    cache = frappe.cache()
+
+    scheme = cache.hget(AUTH_SCHEME_CACHE_KEY, url)
+    if scheme is not None:
+        return scheme
+
+    scheme = discover_auth_scheme(url, token)
+    if scheme is None:
+        # Rien de concluant (serveur indisponible ?): ne pas mémoriser le défaut
+        print(f"⚠️ Aucun format d'Authorization fonctionnel trouvé, utilisation {DEFAULT_AUTH_SCHEME} par défaut")
+        return DEFAULT_AUTH_SCHEME
+
+    cache.hset(AUTH_SCHEME_CACHE_KEY, url, scheme)
+    return scheme
+
+
+def discover_auth_scheme(url, token):
+    """Teste les formats d'Authorization possibles, retourne le premier fonctionnel"""
+    test_url = f"{url}/personnel/api/employees/?page_size=1"
+
+    for scheme in AUTH_SCHEMES:
+        format_name = scheme or 'Token seul'
+        print(f"🧪 Test format: {format_name}")
+
+        try:
+            test_response = get_client().get(
+                test_url, auth=False, headers=build_auth_headers(token, scheme), timeout=5, max_retries=0
+            )
+            print(f"   Status: {test_response.status_code}")
+
+            if test_response.ok:
+                print(f"✅ Format fonctionnel trouvé: {format_name}")
+                return scheme
+            elif test_response.status_code != 401:
+                print(f"   Réponse non-401: {test_response.text[:100]}")
+
+        except Exception as e:
+            print(f"   Erreur: {str(e)[:50]}")
+
+    return None
+
+
+def clear_auth_scheme_cache(url=None):
+    """Oublie le schéma mémorisé (une URL, ou toutes)"""
+    cache = frappe.cache()
+    if url:
+        cache.hdel(AUTH_SCHEME_CACHE_KEY, url)
+    else:
+        cache.delete_value(AUTH_SCHEME_CACHE_KEY)
+
+
+def reset_auth():
+    """À appeler sur un 401: nouveau token et nouvelle découverte du schéma"""
+    clear_token_cache()
+    clear_auth_scheme_cache(frappe.get_single("BioTime Setting").url)
+
+
+def get_token_ttl(token):
+    """Durée de cache du token (secondes), basée sur le claim JWT exp si présent"""
+    exp = get_token_expiry(token)
+    if not exp:
+        return DEFAULT_TOKEN_TTL
+    return int(exp - time.time() - TOKEN_REFRESH_MARGIN)
+
+
+def get_token_expiry(token):
+    """Extrait le claim exp d'un JWT (sans vérifier la signature), None sinon"""
+    parts = (token or "").split(".")
+    if len(parts) != 3:
+        return None
+
+    try:
+        payload = parts[1] + "=" * (-len(parts[1]) % 4)
+        claims = json.loads(base64.urlsafe_b64decode(payload.encode()))
+        return float(claims["exp"])
+    except Exception:
+        return None
+
+
+def request_token():
+    """Récupère un token depuis BioTime selon la documentation officielle"""
+    doc = frappe.get_single("BioTime Setting")
+    # ✅ CORRECTION: Endpoint correct selon la documentation
+    url = doc.url + "/api-token-auth/"
+    headers = {
+        "Content-Type": "application/json",
+    }
+    data = {
+        "username": doc.user_name,
+        "password": doc.get_password('password')
+    }
+
+    print(f"🔐 Récupération token depuis: {url}")
+    print(f"👤 Username: {doc.user_name}")
+    print(f"🔑 Password fourni: {'✅ Oui' if doc.get_password('password') else '❌ Non'}")
+
+    try:
+        response = get_client().post(url, auth=False, data=json.dumps(data), headers=headers, timeout=10)
+
+        print(f"📡 Status Code: {response.status_code}")
+
+        if response.ok:
+            response_data = response.json()
+
+            # ✅ CORRECTION: Selon la doc, le token est dans {"token": "..."}
+            token = response_data.get("token")
+
+            if token:
+                print(f"✅ Token récupéré avec succès: {token[:20]}...")
+                return token
+            else:
+                print(f"❌ Pas de token dans la réponse: {response_data}")
+                frappe.throw(
+                    title='Erreur Token',
+                    msg=f'Token non trouvé. Structure: {response_data}',
+                )
+        else:
+            print(f"❌ Erreur HTTP {response.status_code}: {response.text}")
+            frappe.throw(
+                title='Erreur Authentification',
+                msg=f'Erreur {response.status_code}: Vérifiez vos identifiants BioTime',
+            )
+
+    except requests.exceptions.RequestException as e:
+        print(f"❌ Erreur réseau: {str(e)}")
+        frappe.log_error(
+            message=f"Erreur réseau lors de l'authentification: {str(e)}",
+            title="Erreur Connexion BioTime"
+        )
+        frappe.throw(
+            title='Erreur Connexion',
+            msg='Impossible de se connecter au serveur BioTime. Vérifiez l\'URL.',
+        )
+    except frappe.ValidationError:
+        raise
+    except Exception as e:
+        print(f"❌ Erreur générale: {str(e)}")
+        frappe.log_error(
+            message=f"Erreur lors de la récupération du token: {str(e)}",
+            title="Erreur Token BioTime"
+        )
+        frappe.throw(
+            title='Erreur',
+            msg='Échec de récupération du token. Vérifiez vos paramètres.',
+        )
@@ -57,7 +57,8 @@ app_license = "MIT"
 # ------------
 
 # before_install = "biotime.install.before_install"
-# after_install = "biotime.install.after_install"
+after_install = "biotime.install.after_install"
+after_migrate = "biotime.install.after_migrate"
 
 # Uninstallation
 # ------------
@@ -103,18 +104,41 @@ app_license = "MIT"
 #	}
 # }
 
+doc_events = {
+    # Changements d'employés mis en file (BioTime Outbox), poussés par biotime.outbox.drain_outbox
+    "Employee": {
+        "on_update": "biotime.outbox.enqueue_employee_change",
+        "on_trash": "biotime.outbox.enqueue_employee_deletion"
+    }
+}
+
 # Scheduled Tasks
 # ---------------
 
 scheduler_events = {
+    "hourly_long": [
+        # Miroir local des employés BioTime (incrémental)
+        "biotime.mirror.refresh_employee_mirror"
+    ],
+    "daily_long": [
+        # Liste complète: retire les employés supprimés dans BioTime
+        "biotime.mirror.refresh_employee_mirror_full",
+        # Contrôle de cohérence ERPNext ↔ BioTime (miroir local)
+        "biotime.reconcile.reconcile_employees_nightly",
+        # Staging: transactions traitées au-delà de la rétention
+        "biotime.tasks.purge_processed_transactions"
+    ],
     "cron": {
-        # Job quotidien à 23h pour synchronisation complète
-        "0 23 * * *": [
-            "biotime.api.fetch_transactions"
-        ],
-        # Job toutes les 15 minutes pour synchronisation en temps réel
+        # Job toutes les 15 minutes: synchronisation incrémentale depuis le curseur
+        # (remplace la re-lecture quotidienne du mois complet)
         "*/15 * * * *": [
-            "biotime.api.sync_transactions_scheduled"
+            "biotime.api.sync_transactions_scheduled",
+            # Filet de sécurité: lignes en file laissées par un job interrompu
+            "biotime.tasks.materialize_transactions"
+        ],
+        # Changements Employee en file vers BioTime
+        "*/5 * * * *": [
+            "biotime.outbox.drain_outbox"
         ],
     },
 }
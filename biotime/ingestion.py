@@ -0,0 +1,440 @@
+import json
+
+import frappe
+from frappe.utils import cint, get_datetime, now
+
+# Lignes par INSERT multi-lignes et par commit (si non configuré dans BioTime Setting)
+DEFAULT_COMMIT_EVERY = 500
+
+
+def get_commit_every():
+    """Politique de commit commune à tous les chemins d'intégration"""
+    return cint(frappe.db.get_single_value("BioTime Setting", "commit_every")) or DEFAULT_COMMIT_EVERY
+
+
+class EmployeeMap:
+    """Correspondance attendance_device_id → employé, chargée en une requête par lot"""
+
+    def __init__(self):
+        self.employees = {}
+        self.unknown = set()
+
+    def load(self, emp_codes):
+        """Charge uniquement les codes pas encore connus"""
+        codes = {str(code) for code in emp_codes if code} - self.employees.keys() - self.unknown
+        if not codes:
+            return
+
+        employees = frappe.get_all(
+            "Employee",
+            filters={"attendance_device_id": ["in", list(codes)]},
+            fields=["name", "employee_name", "status", "attendance_device_id", "default_shift"]
+        )
+        for employee in employees:
+            current = self.employees.get(employee.attendance_device_id)
+            # Code partagé par plusieurs fiches: privilégier l'employé actif
+            if not current or (current.status != "Active" and employee.status == "Active"):
+                self.employees[employee.attendance_device_id] = employee
+
+        self.unknown |= codes - self.employees.keys()
+
+    def get(self, emp_code, active_only=False):
+        employee = self.employees.get(str(emp_code)) if emp_code else None
+        if employee and active_only and employee.status != "Active":
+            return None
+        return employee
+
+
+class UnmatchedPunches:
+    """Pointages sans employé correspondant, regroupés par emp_code et enregistrés une fois par run"""
+
+    def __init__(self):
+        self.punches = {}
+        self.count = 0
+
+    def add(self, transaction):
+        emp_code = transaction.get("emp_code")
+        punch_time = transaction.get("punch_time")
+        if not emp_code or not punch_time:
+            return
+
+        self.count += 1
+        punch_time = get_datetime(punch_time)
+        transaction_id = cint(transaction.get("id"))
+        punch = self.punches.get(str(emp_code))
+        if not punch:
+            self.punches[str(emp_code)] = frappe._dict(
+                ids={transaction_id}, first_punch=punch_time, last_punch=punch_time,
+                terminal_sn=transaction.get("terminal_sn")
+            )
+            return
+
+        punch.ids.add(transaction_id)
+        punch.first_punch = min(punch.first_punch, punch_time)
+        if punch_time >= punch.last_punch:
+            punch.last_punch = punch_time
+            punch.terminal_sn = transaction.get("terminal_sn") or punch.terminal_sn
+
+    def save(self):
+        """Crée ou met à jour un Unmatched BioTime Punch par emp_code
+
+        Les compteurs sont recalculés depuis BioTime Failed Transaction (une ligne par id de
+        transaction, donc sans double compte), quel que soit l'ordre des shards ou des périodes:
+        les transactions en échec doivent être enregistrées avant cet appel.
+        """
+        if not self.punches:
+            return
+
+        existing = set(frappe.get_all(
+            "Unmatched BioTime Punch", filters={"name": ["in", list(self.punches)]}, pluck="name"
+        ))
+        for emp_code, punch in self.punches.items():
+            if emp_code in existing:
+                continue
+            try:
+                frappe.get_doc({
+                    "doctype": "Unmatched BioTime Punch",
+                    "emp_code": emp_code,
+                    "punch_count": len(punch.ids),
+                    "first_punch": punch.first_punch,
+                    "last_punch": punch.last_punch,
+                    "terminal_sn": punch.terminal_sn,
+                    "last_transaction_id": max(punch.ids),
+                }).insert(ignore_permissions=True)
+            except frappe.DuplicateEntryError:
+                # Créé entre-temps par un autre shard: recalculé ci-dessous
+                pass
+
+        refresh_unmatched_punches(self.punches)
+
+        # Terminal du dernier pointage connu
+        for emp_code, punch in self.punches.items():
+            frappe.db.sql("""
+                UPDATE `tabUnmatched BioTime Punch`
+                SET terminal_sn = %s
+                WHERE name = %s AND (last_punch IS NULL OR last_punch <= %s)
+            """, (punch.terminal_sn, emp_code, punch.last_punch))
+
+        frappe.db.commit()
+
+
+def refresh_unmatched_punches(emp_codes):
+    """Recalcule les Unmatched BioTime Punch depuis les transactions en file (BioTime Failed Transaction)
+
+    Une requête pour les compteurs et bornes; les codes sans transaction restante sont retirés.
+    """
+    emp_codes = tuple(emp_codes)
+    if not emp_codes:
+        return
+
+    frappe.db.sql("""
+        UPDATE `tabUnmatched BioTime Punch` unmatched
+        JOIN (
+            SELECT emp_code, COUNT(*) AS punch_count, MIN(punch_time) AS first_punch,
+                MAX(punch_time) AS last_punch, MAX(CAST(transaction_id AS UNSIGNED)) AS last_transaction_id
+            FROM `tabBioTime Failed Transaction`
+            WHERE emp_code IN %(emp_codes)s
+            GROUP BY emp_code
+        ) failed ON failed.emp_code = unmatched.name
+        SET unmatched.punch_count = failed.punch_count,
+            unmatched.first_punch = failed.first_punch,
+            unmatched.last_punch = failed.last_punch,
+            unmatched.last_transaction_id = failed.last_transaction_id,
+            unmatched.modified = %(timestamp)s
+    """, {"emp_codes": emp_codes, "timestamp": now()})
+
+    frappe.db.sql("""
+        DELETE FROM `tabUnmatched BioTime Punch`
+        WHERE name IN %(emp_codes)s
+            AND NOT EXISTS (
+                SELECT 1 FROM `tabBioTime Failed Transaction` failed WHERE failed.emp_code = `tabUnmatched BioTime Punch`.name
+            )
+    """, {"emp_codes": emp_codes})
+
+
+class FailedTransactions:
+    """Dead-letter: transactions en échec conservées brutes (raison, tentatives) pour rejeu par lot"""
+
+    def __init__(self):
+        self.failures = {}
+
+    def add(self, transaction, reason):
+        if transaction.get("id") is None:
+            return
+        self.failures[str(transaction.get("id"))] = (transaction, str(reason))
+
+    def save(self):
+        """Insère les nouveaux échecs et incrémente les tentatives des existants (requêtes groupées)"""
+        if not self.failures:
+            return
+
+        failures, self.failures = self.failures, {}
+        timestamp = now()
+        existing = set(frappe.get_all(
+            "BioTime Failed Transaction",
+            filters={"name": ["in", list(failures)]},
+            pluck="name"
+        ))
+
+        fields = [
+            "name", "transaction_id", "emp_code", "punch_time", "attempts", "last_attempt", "reason",
+            "payload", "owner", "modified_by", "creation", "modified", "docstatus"
+        ]
+        values = [
+            [
+                transaction_id, transaction_id, transaction.get("emp_code"),
+                get_datetime(transaction.get("punch_time")) if transaction.get("punch_time") else None,
+                1, timestamp, reason, json.dumps(transaction, default=str),
+                frappe.session.user, frappe.session.user, timestamp, timestamp, 0
+            ]
+            for transaction_id, (transaction, reason) in failures.items()
+            if transaction_id not in existing
+        ]
+        if values:
+            frappe.db.bulk_insert("BioTime Failed Transaction", fields, values, ignore_duplicates=True)
+
+        # Nouvel échec d'une transaction déjà en file: une requête par raison distincte
+        by_reason = {}
+        for transaction_id in existing:
+            by_reason.setdefault(failures[transaction_id][1], []).append(transaction_id)
+        for reason, names in by_reason.items():
+            frappe.db.sql("""
+                UPDATE `tabBioTime Failed Transaction`
+                SET attempts = attempts + 1, last_attempt = %(timestamp)s, reason = %(reason)s, modified = %(timestamp)s
+                WHERE name IN %(names)s
+            """, {"timestamp": timestamp, "reason": reason, "names": tuple(names)})
+
+        frappe.db.commit()
+
+
+class CheckinWriter:
+    """Écriture groupée des Employee Checkin: préparation en mémoire, INSERT multi-lignes, un commit par lot
+
+    Les lignes en échec vont dans failed (BioTime Failed Transaction), enregistré à close()
+    sauf s'il est fourni par l'appelant.
+    """
+
+    def __init__(self, batch_size=None, failed=None):
+        self.batch_size = batch_size or get_commit_every()
+        self.own_failed = failed is None
+        self.failed = FailedTransactions() if failed is None else failed
+        self.rows = []
+        self.keys = set()
+        self.stats = frappe._dict(created=0, duplicates=0, errors=0)
+        # Shift Type des check-ins réellement créés (marqueur last_sync_of_checkin ciblé)
+        self.shifts = set()
+        self.default_shifts = {}
+
+    def add(self, employee, time, log_type, transaction, employee_name=None, device_id=None, extra=None,
+            default_shift=None):
+        """Ajoute un check-in au lot courant (écrit quand le lot est plein)"""
+        time = get_datetime(time)
+        key = (employee, time, log_type or "")
+        # Doublon à l'intérieur du lot: invisible pour les contrôles en base
+        if key in self.keys:
+            self.stats.duplicates += 1
+            return
+        self.keys.add(key)
+        if default_shift:
+            self.default_shifts[employee] = default_shift
+
+        row = {
+            "employee": employee,
+            "employee_name": employee_name,
+            "time": time,
+            "log_type": log_type,
+            "device_id": device_id,
+            "transaction_id": str(transaction.get("id")) if transaction.get("id") is not None else None,
+        }
+        if extra:
+            row.update(extra)
+        self.rows.append((row, transaction))
+
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Prépare les documents du lot, les insère en une requête et commite"""
+        if not self.rows:
+            return
+
+        rows, self.rows, self.keys = self.rows, [], set()
+        rows = self.drop_existing(rows)
+        docs = []
+        for row, transaction in rows:
+            try:
+                doc = make_checkin_doc(row)
+                doc.flags.transaction = transaction
+                docs.append(doc)
+            except Exception as e:
+                self.stats.errors += 1
+                self.failed.add(transaction, e)
+
+        if docs:
+            try:
+                insert_checkin_docs(docs)
+            except Exception:
+                # Une ligne invalide fait échouer tout l'INSERT: isoler ligne par ligne
+                frappe.db.rollback()
+                docs = self.insert_one_by_one(docs)
+
+        frappe.db.commit()
+        inserted = get_inserted(docs)
+        self.stats.created += len(inserted)
+        # INSERT IGNORE: les transactions déjà présentes sont simplement ignorées
+        self.stats.duplicates += len(docs) - len(inserted)
+        for doc in docs:
+            shift = doc.get("shift") or self.default_shifts.get(doc.employee)
+            if shift and doc.name in inserted:
+                self.shifts.add(shift)
+
+    def drop_existing(self, rows):
+        """Retire les check-ins déjà en base: une seule requête IN pour tout le lot"""
+        transaction_ids = {row["transaction_id"] for row, _ in rows if row["transaction_id"]}
+        existing = frappe.db.sql("""
+            SELECT transaction_id, employee, time, log_type
+            FROM `tabEmployee Checkin`
+            WHERE transaction_id IN %(transaction_ids)s
+                OR (employee IN %(employees)s AND time IN %(times)s)
+        """, {
+            "transaction_ids": tuple(transaction_ids) or ("",),
+            "employees": tuple({row["employee"] for row, _ in rows}),
+            "times": tuple({row["time"] for row, _ in rows}),
+        }, as_dict=True)
+
+        if not existing:
+            return rows
+
+        existing_ids = {str(checkin.transaction_id) for checkin in existing if checkin.transaction_id}
+        existing_keys = {
+            (checkin.employee, get_datetime(checkin.time), checkin.log_type or "") for checkin in existing
+        }
+
+        remaining = []
+        for row, transaction in rows:
+            key = (row["employee"], row["time"], row["log_type"] or "")
+            if row["transaction_id"] in existing_ids or key in existing_keys:
+                self.stats.duplicates += 1
+            else:
+                remaining.append((row, transaction))
+        return remaining
+
+    def insert_one_by_one(self, docs):
+        inserted = []
+        for doc in docs:
+            try:
+                doc.db_insert()
+                inserted.append(doc)
+            except frappe.DuplicateEntryError:
+                self.stats.duplicates += 1
+            except Exception as e:
+                self.stats.errors += 1
+                self.failed.add(doc.flags.transaction, e)
+        return inserted
+
+    def close(self):
+        """Écrit le dernier lot, marque les Shift Type concernés et retourne les compteurs"""
+        self.flush()
+        mark_shifts_synced(self.shifts)
+        self.shifts = set()
+        if self.own_failed:
+            self.failed.save()
+        return self.stats
+
+
+def make_checkin_doc(row):
+    """Construit un Employee Checkin en mémoire, avec les seuls traitements nécessaires à ERPNext"""
+    doc = frappe.new_doc("Employee Checkin")
+    doc.update(row)
+
+    # Rattachement au poste (shift, début/fin réels): requis par la présence automatique
+    if hasattr(doc, "fetch_shift"):
+        doc.fetch_shift()
+
+    timestamp = now()
+    doc.name = frappe.generate_hash(length=10)
+    doc.owner = doc.modified_by = frappe.session.user
+    doc.creation = doc.modified = timestamp
+    doc.docstatus = 0
+    return doc
+
+
+def insert_checkin_docs(docs):
+    """INSERT multi-lignes; les transaction_id déjà présents sont ignorés (index unique)"""
+    rows = [doc.get_valid_dict(convert_dates_to_str=True) for doc in docs]
+    fields = list(rows[0].keys())
+    values = [[row.get(field) for field in fields] for row in rows]
+    frappe.db.bulk_insert("Employee Checkin", fields, values, ignore_duplicates=True)
+
+
+def get_inserted(docs):
+    names = [doc.name for doc in docs]
+    if not names:
+        return set()
+    return set(frappe.get_all("Employee Checkin", filters={"name": ["in", names]}, pluck="name"))
+
+
+def mark_shifts_synced(shifts):
+    """last_sync_of_checkin des seuls Shift Type concernés par les nouveaux check-ins, en une requête"""
+    if not shifts:
+        return
+    frappe.db.sql("""
+        UPDATE `tabShift Type`
+        SET last_sync_of_checkin = %(timestamp)s
+        WHERE name IN %(shifts)s AND enable_auto_attendance = 1
+    """, {"timestamp": now(), "shifts": tuple(shifts)})
+    frappe.db.commit()
+
+
+def stage_transactions(transactions):
+    """Pointages bruts → BioTime Transaction (INSERT multi-lignes, un commit par lot); retourne le nombre de nouveaux"""
+    timestamp = now()
+    fields = [
+        "name", "transaction_id", "emp_code", "punch_time", "punch_state", "terminal_sn", "upload_time",
+        "processed", "payload", "owner", "modified_by", "creation", "modified", "docstatus"
+    ]
+    commit_every = get_commit_every()
+    staged = 0
+
+    for start in range(0, len(transactions), commit_every):
+        chunk = {
+            str(transaction.get("id")): transaction
+            for transaction in transactions[start:start + commit_every]
+            if transaction.get("id") is not None
+        }
+        if not chunk:
+            continue
+
+        # Pull idempotent: les transactions déjà en file sont ignorées
+        existing = set(frappe.get_all(
+            "BioTime Transaction", filters={"name": ["in", list(chunk)]}, pluck="name"
+        ))
+        values = [
+            [
+                transaction_id, transaction_id, transaction.get("emp_code"),
+                get_datetime(transaction.get("punch_time")) if transaction.get("punch_time") else None,
+                transaction.get("punch_state"), transaction.get("terminal_sn"),
+                get_datetime(transaction.get("upload_time")) if transaction.get("upload_time") else None,
+                0, json.dumps(transaction, default=str),
+                frappe.session.user, frappe.session.user, timestamp, timestamp, 0
+            ]
+            for transaction_id, transaction in chunk.items()
+            if transaction_id not in existing
+        ]
+        if values:
+            frappe.db.bulk_insert("BioTime Transaction", fields, values, ignore_duplicates=True)
+            staged += len(values)
+        frappe.db.commit()
+
+    return staged
+
+
+def mark_transactions_processed(names):
+    if not names:
+        return
+    frappe.db.sql("""
+        UPDATE `tabBioTime Transaction`
+        SET processed = 1
+        WHERE name IN %(names)s
+    """, {"names": tuple(names)})
+    frappe.db.commit()
@@ -0,0 +1,19 @@
+import frappe
+
+
+def after_install():
+    ensure_checkin_indexes()
+
+
+def after_migrate():
+    # Nouvelle installation: les patches sont marqués exécutés sans tourner, et le champ
+    # personnalisé transaction_id n'est synchronisé qu'après les patches post_model_sync
+    ensure_checkin_indexes()
+
+
+def ensure_checkin_indexes():
+    """Index (employee, time) utilisé par la déduplication par lot des check-ins (idempotent)
+
+    L'unicité de transaction_id est portée par le champ personnalisé lui-même (unique: 1).
+    """
+    frappe.db.add_index("Employee Checkin", ["employee", "time"], index_name="biotime_employee_time")
@@ -0,0 +1,99 @@
+import re
+import unicodedata
+from collections import defaultdict
+
+import frappe
+
+# Score minimal pour retenir un rapprochement automatique (0..1)
+MIN_MATCH_SCORE = 0.45
+# Une inclusion de mots complets (ex. "RH" dans "RH Siège") reste un bon candidat
+CONTAINMENT_SCORE = 0.75
+
+
+def normalize(text):
+    """Minuscules, sans accents ni ponctuation, espaces simples"""
+    text = unicodedata.normalize("NFKD", str(text or "")).encode("ascii", "ignore").decode()
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", text.lower()).split())
+
+
+def get_trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class NameIndex:
+    """Index token/trigramme de libellés ERPNext, construit une fois par run
+
+    search() retourne les candidats classés [(name, score)], best() le premier
+    au-dessus du score minimal. Les recherches identiques sont mémorisées.
+    """
+
+    def __init__(self, records):
+        self.entries = []
+        self.exact = {}
+        self.postings = defaultdict(set)
+        self.results = {}
+
+        for name, label in records:
+            text = normalize(label or name)
+            if not text:
+                continue
+            position = len(self.entries)
+            self.entries.append((name, text, set(text.split()), get_trigrams(text)))
+            self.exact.setdefault(text, name)
+            for trigram in self.entries[position][3]:
+                self.postings[trigram].add(position)
+
+    @classmethod
+    def for_doctype(cls, doctype, label_field):
+        return cls((row.name, row.get(label_field)) for row in frappe.get_all(doctype, fields=["name", label_field]))
+
+    def search(self, label, limit=5):
+        text = normalize(label)
+        if not text:
+            return []
+        if (text, limit) in self.results:
+            return self.results[(text, limit)]
+
+        if text in self.exact:
+            result = [(self.exact[text], 1.0)]
+        else:
+            tokens, trigrams = set(text.split()), get_trigrams(text)
+            # Seuls les libellés partageant au moins un trigramme sont évalués
+            candidates = set()
+            for trigram in trigrams:
+                candidates |= self.postings.get(trigram, set())
+
+            scores = {}
+            for position in candidates:
+                name, entry_text, entry_tokens, entry_trigrams = self.entries[position]
+                score = 0.7 * (2 * len(trigrams & entry_trigrams) / (len(trigrams) + len(entry_trigrams)))
+                score += 0.3 * len(tokens & entry_tokens) / len(tokens | entry_tokens)
+                if tokens <= entry_tokens or entry_tokens <= tokens:
+                    score = max(score, CONTAINMENT_SCORE)
+                scores[name] = max(scores.get(name, 0), round(score, 3))
+            result = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:limit]
+
+        self.results[(text, limit)] = result
+        return result
+
+    def best(self, label, min_score=MIN_MATCH_SCORE):
+        candidates = self.search(label, limit=1)
+        if candidates and candidates[0][1] >= min_score:
+            return candidates[0][0]
+        return None
+
+
+def get_department_index():
+    return NameIndex.for_doctype("Department", "department_name")
+
+
+def get_designation_index():
+    return NameIndex.for_doctype("Designation", "designation_name")
+
+
+@frappe.whitelist()
+def get_mapping_candidates(label, doctype="Department"):
+    """Candidats classés pour un libellé BioTime (aide à la saisie manuelle)"""
+    index = get_designation_index() if doctype == "Designation" else get_department_index()
+    return [{"name": name, "score": score} for name, score in index.search(label)]
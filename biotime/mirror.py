@@ -0,0 +1,170 @@
+import hashlib
+import json
+
+import frappe
+from frappe import _
+from frappe.utils import cint, get_datetime, now
+
+from biotime.client import get_client
+from biotime.ingestion import get_commit_every
+from biotime.utils import ProgressReporter
+
+EMPLOYEES_PATH = "/personnel/api/employees/"
+MIRROR_PAGE_SIZE = 100
+MIRROR_FIELDS = [
+    "name", "emp_code", "first_name", "last_name", "biotime_id", "department", "department_id",
+    "position", "position_id", "area", "is_active", "update_time", "content_hash", "payload",
+    "owner", "modified_by", "creation", "modified", "docstatus"
+]
+
+
+@frappe.whitelist()
+def enqueue_employee_mirror_refresh(full=False):
+    """Rafraîchit le miroir BioTime Employee en arrière-plan"""
+    frappe.only_for(("HR Manager", "System Manager"))
+    frappe.enqueue("biotime.mirror.refresh_employee_mirror", queue="long", timeout=3600, full=cint(full))
+    return {"status": "queued", "message": _("Rafraîchissement des employés BioTime lancé en arrière-plan")}
+
+
+def refresh_employee_mirror(full=False):
+    """Copie locale de /personnel/api/employees/: seules les fiches nouvelles ou modifiées sont écrites
+
+    Incrémental par update_time quand BioTime le fournit (filtre update_time__gte), sinon
+    liste complète comparée par empreinte. Une liste complète retire aussi les fiches supprimées.
+    """
+    client = get_client()
+    params = {"page_size": MIRROR_PAGE_SIZE}
+    since = None if full else frappe.db.sql("SELECT MAX(update_time) FROM `tabBioTime Employee`")[0][0]
+    if since:
+        params["update_time__gte"] = get_datetime(since).strftime("%Y-%m-%d %H:%M:%S")
+
+    hashes = dict(frappe.db.sql("SELECT name, content_hash FROM `tabBioTime Employee`"))
+    concurrency = cint(frappe.db.get_single_value("BioTime Setting", "fetch_concurrency")) or 1
+    stats = frappe._dict(fetched=0, created=0, updated=0, deleted=0)
+    seen = set()
+    pending = []
+    progress = ProgressReporter(title="Refreshing BioTime Employees...")
+
+    for page in client.iter_pages(EMPLOYEES_PATH, params, concurrency):
+        for employee in page.get("data") or []:
+            record = make_mirror_record(employee)
+            if not record:
+                continue
+            seen.add(record["emp_code"])
+            current = hashes.get(record["emp_code"])
+            if current == record["content_hash"]:
+                continue
+            stats["updated" if current else "created"] += 1
+            pending.append(record)
+
+        stats.fetched += len(page.get("data") or [])
+        progress.update(stats.fetched, cint(page.get("count")))
+        if len(pending) >= get_commit_every():
+            write_mirror_records(pending)
+            pending = []
+
+    write_mirror_records(pending)
+
+    # Liste non filtrée: les codes absents ont été supprimés dans BioTime
+    if not since:
+        # Fiches référencées par une Employee Discovery: seule copie de leur donnée brute, conservées
+        referenced = set(frappe.get_all(
+            "Employee Discovery", filters={"biotime_employee": ["is", "set"]}, pluck="biotime_employee"
+        ))
+        stale = [emp_code for emp_code in hashes if emp_code not in seen and emp_code not in referenced]
+        if stale:
+            frappe.db.delete("BioTime Employee", {"name": ["in", stale]})
+            frappe.db.commit()
+        stats.deleted = len(stale)
+
+    progress.finish()
+    return stats
+
+
+def refresh_employee_mirror_full():
+    """Job quotidien: liste complète (retire aussi les employés supprimés dans BioTime)"""
+    return refresh_employee_mirror(full=True)
+
+
+def make_mirror_record(employee):
+    emp_code = str(employee.get("emp_code") or "").strip()
+    if not emp_code:
+        return None
+
+    department = employee.get("department") if isinstance(employee.get("department"), dict) else {}
+    position = employee.get("position") if isinstance(employee.get("position"), dict) else {}
+    areas = employee.get("area") if isinstance(employee.get("area"), list) else []
+    update_time = employee.get("update_time")
+
+    return {
+        "emp_code": emp_code,
+        "first_name": employee.get("first_name") or "",
+        "last_name": employee.get("last_name") or "",
+        "biotime_id": cint(employee.get("id")),
+        "department": department.get("dept_name") or "",
+        "department_id": cint(department.get("id")),
+        "position": position.get("position_name") or "",
+        "position_id": cint(position.get("id")),
+        "area": ", ".join(area.get("area_name") or "" for area in areas if isinstance(area, dict)),
+        "is_active": 1 if employee.get("is_active", True) else 0,
+        "update_time": get_datetime(update_time) if update_time else None,
+        "content_hash": get_content_hash(employee),
+        "payload": json.dumps(employee, ensure_ascii=False, default=str),
+    }
+
+
+def get_content_hash(employee):
+    return hashlib.sha1(json.dumps(employee, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def write_mirror_records(records):
+    """Remplace les fiches modifiées: un DELETE et un INSERT multi-lignes par lot"""
+    if not records:
+        return
+
+    timestamp = now()
+    names = [record["emp_code"] for record in records]
+    frappe.db.delete("BioTime Employee", {"name": ["in", names]})
+    values = [
+        [record["emp_code"]] + [record[field] for field in MIRROR_FIELDS[1:-5]]
+        + [frappe.session.user, frappe.session.user, timestamp, timestamp, 0]
+        for record in records
+    ]
+    frappe.db.bulk_insert("BioTime Employee", MIRROR_FIELDS, values)
+    frappe.db.commit()
+
+
+def get_mirror_employees(emp_codes=None):
+    """Fiches BioTime brutes (format API) depuis le miroir"""
+    filters = {"name": ["in", list(emp_codes)]} if emp_codes is not None else {}
+    if emp_codes is not None and not emp_codes:
+        return []
+    return [
+        json.loads(payload)
+        for payload in frappe.get_all("BioTime Employee", filters=filters, pluck="payload", order_by="name asc")
+        if payload
+    ]
+
+
+def get_mirror_payload(emp_code):
+    """Fiche BioTime brute d'un employé (None si absente du miroir)"""
+    payload = frappe.db.get_value("BioTime Employee", emp_code, "payload") if emp_code else None
+    return json.loads(payload) if payload else None
+
+
+def get_unmapped_emp_codes():
+    """Codes BioTime sans Employee ERPNext (attendance_device_id), en une requête"""
+    return frappe.db.sql_list("""
+        SELECT mirror.name
+        FROM `tabBioTime Employee` mirror
+        WHERE NOT EXISTS (
+            SELECT 1 FROM `tabEmployee` employee
+            WHERE employee.attendance_device_id = mirror.emp_code
+        )
+    """)
+
+
+def ensure_employee_mirror():
+    """Premier usage: remplit le miroir (ensuite rafraîchi par le planificateur)"""
+    if not frappe.db.count("BioTime Employee"):
+        refresh_employee_mirror(full=True)
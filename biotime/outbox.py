@@ -0,0 +1,238 @@
+import frappe
+from frappe import _
+from frappe.utils import add_to_date, now, now_datetime
+
+from biotime.api import find_biotime_department_id, get_biotime_position_id
+from biotime.client import get_client
+from biotime.ingestion import get_commit_every
+from biotime.mirror import EMPLOYEES_PATH
+
+# Champs Employee répercutés dans BioTime
+TRACKED_FIELDS = ("employee_name", "first_name", "last_name", "department", "designation", "status", "cell_number")
+OUTBOX_LOCK_KEY = "biotime:outbox_lock"
+OUTBOX_LOCK_TIMEOUT = 1800
+MAX_OUTBOX_ATTEMPTS = 8
+
+
+def enqueue_employee_change(doc, method=None):
+    """Employee.on_update: une ligne d'outbox par employé (les modifications successives fusionnent)"""
+    if not doc.attendance_device_id or doc.flags.from_biotime:
+        # Pas encore dans BioTime (créé par la synchronisation ERPNext → BioTime) ou créé depuis BioTime
+        return
+    if not any(doc.has_value_changed(field) for field in TRACKED_FIELDS):
+        return
+    if doc.status != "Active" and is_code_held_by_active(doc.attendance_device_id, doc.name):
+        # Ancienne fiche (ex. réembauche): le badge BioTime appartient à l'employé actif
+        return
+    write_outbox(doc.name, doc.attendance_device_id, "Update")
+
+
+def enqueue_employee_deletion(doc, method=None):
+    """Employee.on_trash: désactivation (pas de suppression) de la fiche BioTime"""
+    if doc.attendance_device_id and not is_code_held_by_active(doc.attendance_device_id, doc.name):
+        write_outbox(doc.name, doc.attendance_device_id, "Deactivate")
+
+
+def is_code_held_by_active(emp_code, exclude=None):
+    """Un autre Employee actif utilise-t-il ce attendance_device_id?"""
+    return bool(frappe.db.exists("Employee", {
+        "attendance_device_id": emp_code, "status": "Active", "name": ["!=", exclude or ""]
+    }))
+
+
+def write_outbox(employee, emp_code, action):
+    """Upsert sur le nom (= employé): la dernière action gagne et les tentatives repartent de zéro"""
+    timestamp = now()
+    frappe.db.sql("""
+        INSERT INTO `tabBioTime Outbox`
+            (name, employee, emp_code, action, changed_at, status, attempts,
+             owner, modified_by, creation, modified, docstatus)
+        VALUES (%(employee)s, %(employee)s, %(emp_code)s, %(action)s, %(timestamp)s, 'Pending', 0,
+             %(user)s, %(user)s, %(timestamp)s, %(timestamp)s, 0)
+        ON DUPLICATE KEY UPDATE
+            emp_code = VALUES(emp_code), action = VALUES(action), changed_at = VALUES(changed_at),
+            status = 'Pending', attempts = 0, next_attempt = NULL, last_error = NULL,
+            modified = VALUES(modified), modified_by = VALUES(modified_by)
+    """, {"employee": employee, "emp_code": emp_code, "action": action, "timestamp": timestamp, "user": frappe.session.user})
+
+
+def drain_outbox():
+    """Pousse les changements en attente vers BioTime, par lots, dans l'ordre des modifications"""
+    cache = frappe.cache()
+    # Un seul drainer: jamais deux envois concurrents pour un même employé
+    lock = cache.lock(cache.make_key(OUTBOX_LOCK_KEY), timeout=OUTBOX_LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        return
+
+    stats = frappe._dict(pushed=0, failed=0)
+    try:
+        client = get_client()
+        batch_size = get_commit_every()
+        while True:
+            rows = frappe.db.sql("""
+                SELECT name, emp_code, action, changed_at, attempts
+                FROM `tabBioTime Outbox`
+                WHERE status = 'Pending' AND (next_attempt IS NULL OR next_attempt <= %s)
+                ORDER BY changed_at ASC
+                LIMIT %s
+            """, (now(), batch_size), as_dict=True)
+            if not rows:
+                break
+
+            done, failures = push_outbox_rows(client, rows)
+            complete_outbox_rows(done)
+            for row, error in failures:
+                fail_outbox_row(row, error)
+            frappe.db.commit()
+
+            stats.pushed += len(done)
+            stats.failed += len(failures)
+    finally:
+        try:
+            lock.release()
+        except Exception:
+            # Verrou expiré entre-temps: rien à libérer
+            pass
+    return stats
+
+
+def push_outbox_rows(client, rows):
+    """Envoie un lot; retourne (lignes traitées, [(ligne, erreur)])"""
+    updates = [row.name for row in rows if row.action == "Update"]
+    employees = {
+        employee.name: employee
+        for employee in frappe.get_all(
+            "Employee",
+            filters={"name": ["in", updates]},
+            fields=["name", "employee_name", "first_name", "last_name", "department", "designation", "status", "cell_number"]
+        )
+    } if updates else {}
+    biotime_ids = dict(frappe.db.sql(
+        "SELECT name, biotime_id FROM `tabBioTime Employee` WHERE name IN %s", (tuple(row.emp_code for row in rows),)
+    ))
+    # Badges utilisés par un employé actif: jamais désactivés par une autre fiche
+    active_holders = {
+        (employee.attendance_device_id, employee.name)
+        for employee in frappe.get_all(
+            "Employee",
+            filters={"status": "Active", "attendance_device_id": ["in", [row.emp_code for row in rows]]},
+            fields=["name", "attendance_device_id"]
+        )
+    }
+    # Département non résolu: non envoyé (jamais de repli sur le département 1 pour une mise à jour)
+    department_ids = {dept: find_biotime_department_id(dept) for dept in {e.department for e in employees.values()}}
+    position_ids = {desig: get_biotime_position_id(desig) for desig in {e.designation for e in employees.values()}}
+
+    done, failures = [], []
+    for row in rows:
+        try:
+            held_by_other = any(code == row.emp_code and name != row.name for code, name in active_holders)
+            if held_by_other and (row.action == "Deactivate" or employees.get(row.name, {}).get("status") != "Active"):
+                # Badge repris par un autre employé actif depuis la mise en file: rien à envoyer
+                done.append(row)
+                continue
+            biotime_id = biotime_ids.get(row.emp_code) or find_biotime_id(client, row.emp_code)
+            if row.action == "Deactivate":
+                error = update_biotime_employee(client, biotime_id, {"is_active": False}) if biotime_id else None
+                if biotime_id and not error:
+                    mark_mirror_active(row.emp_code, False)
+            elif row.name not in employees:
+                # Supprimé depuis: la ligne Deactivate suivante prendra le relais
+                error = None
+            elif not biotime_id:
+                error = f"Employé {row.emp_code} introuvable dans BioTime"
+            else:
+                employee = employees[row.name]
+                payload = make_update_payload(
+                    employee, department_ids.get(employee.department), position_ids.get(employee.designation))
+                error = update_biotime_employee(client, biotime_id, payload)
+                if not error:
+                    mark_mirror_active(row.emp_code, payload["is_active"])
+        except Exception as e:
+            error = str(e)
+
+        if error:
+            failures.append((row, error))
+        else:
+            done.append(row)
+    return done, failures
+
+
+def find_biotime_id(client, emp_code):
+    """Id BioTime hors miroir (employé créé depuis le dernier rafraîchissement)"""
+    response = client.get(EMPLOYEES_PATH, params={"emp_code": emp_code})
+    if not response.ok:
+        return None
+    for employee in response.json().get("data") or []:
+        if str(employee.get("emp_code")) == str(emp_code):
+            return employee.get("id")
+    return None
+
+
+def make_update_payload(employee, department_id, position_id):
+    name_parts = (employee.employee_name or "").split()
+    payload = {
+        "first_name": employee.first_name or (name_parts[0] if name_parts else ""),
+        "last_name": employee.last_name or " ".join(name_parts[1:]),
+        "mobile": employee.cell_number or "",
+        "is_active": employee.status == "Active",
+    }
+    if department_id:
+        payload["department"] = department_id
+    if position_id:
+        payload["position"] = position_id
+    return payload
+
+
+def update_biotime_employee(client, biotime_id, payload):
+    response = client.request("PATCH", f"{EMPLOYEES_PATH}{biotime_id}/", json=payload)
+    if not response.ok:
+        return f"{response.status_code} - {response.text[:500]}"
+    return None
+
+
+def mark_mirror_active(emp_code, is_active):
+    """État actif répercuté dans le miroir: la réconciliation ne le re-propose pas"""
+    frappe.db.sql(
+        "UPDATE `tabBioTime Employee` SET is_active = %s WHERE name = %s", (1 if is_active else 0, emp_code)
+    )
+
+
+def complete_outbox_rows(rows):
+    """Retire les lignes envoyées, sauf celles modifiées pendant l'envoi (changed_at différent)"""
+    if not rows:
+        return
+    frappe.db.sql("""
+        DELETE FROM `tabBioTime Outbox`
+        WHERE (name, changed_at) IN %s
+    """, (tuple((row.name, row.changed_at) for row in rows),))
+
+
+def fail_outbox_row(row, error):
+    """Nouvelle tentative avec délai exponentiel; abandon (Failed) après MAX_OUTBOX_ATTEMPTS"""
+    attempts = row.attempts + 1
+    frappe.db.sql("""
+        UPDATE `tabBioTime Outbox`
+        SET attempts = %(attempts)s, status = %(status)s, next_attempt = %(next_attempt)s, last_error = %(error)s
+        WHERE name = %(name)s AND changed_at = %(changed_at)s
+    """, {
+        "attempts": attempts,
+        "status": "Failed" if attempts >= MAX_OUTBOX_ATTEMPTS else "Pending",
+        "next_attempt": add_to_date(now_datetime(), minutes=2 ** attempts),
+        "error": error[:1000],
+        "name": row.name,
+        "changed_at": row.changed_at,
+    })
+
+
+@frappe.whitelist()
+def retry_failed_outbox():
+    """Remet en file les changements abandonnés"""
+    frappe.only_for(("HR Manager", "System Manager"))
+    frappe.db.sql("""
+        UPDATE `tabBioTime Outbox`
+        SET status = 'Pending', attempts = 0, next_attempt = NULL
+        WHERE status = 'Failed'
+    """)
+    frappe.enqueue("biotime.outbox.drain_outbox", queue="long", timeout=OUTBOX_LOCK_TIMEOUT)
+    return {"status": "queued", "message": _("Changements en échec remis en file")}
@@ -0,0 +1,6 @@
+from biotime.install import ensure_checkin_indexes
+
+
+def execute():
+	"""Index pour la déduplication par lot des check-ins BioTime (aussi assuré par after_migrate)"""
+	ensure_checkin_indexes()
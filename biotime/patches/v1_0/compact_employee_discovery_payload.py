@@ -0,0 +1,51 @@
+import json
+
+import frappe
+
+from biotime.mirror import get_content_hash, make_mirror_record, write_mirror_records
+from biotime.utils import bulk_update_column
+
+
+def execute():
+	"""Employee Discovery: champs consommés en colonnes typées, JSON brut retiré (référence au miroir)"""
+	if not frappe.db.has_column("Employee Discovery", "biotime_data"):
+		return
+
+	rows = frappe.db.sql("""
+		SELECT name, device_id, biotime_data, biotime_data_hash
+		FROM `tabEmployee Discovery`
+		WHERE IFNULL(biotime_data, '') != ''
+	""", as_dict=True)
+
+	mirrored = set(frappe.db.sql_list("SELECT name FROM `tabBioTime Employee`"))
+	mirror_records = {}
+	columns = {"mobile": {}, "office_tel": {}, "biotime_employee": {}, "biotime_data_hash": {}}
+	for row in rows:
+		try:
+			data = json.loads(row.biotime_data)
+		except ValueError:
+			data = {}
+		for field in ("mobile", "office_tel"):
+			if data.get(field):
+				columns[field][row.name] = data[field]
+		if data and not row.biotime_data_hash:
+			# Même empreinte que la découverte: la prochaine passe ne réécrit pas la fiche
+			columns["biotime_data_hash"][row.name] = get_content_hash(data)
+
+		# Fiche brute conservée dans le miroir (vide juste après sa création, ou employé retiré de BioTime)
+		record = make_mirror_record(data) if data else None
+		if record and record["emp_code"] not in mirrored:
+			mirror_records[record["emp_code"]] = record
+		if record or row.device_id in mirrored:
+			columns["biotime_employee"][row.name] = record["emp_code"] if record else row.device_id
+
+	records = list(mirror_records.values())
+	for start in range(0, len(records), 500):
+		write_mirror_records(records[start:start + 500])
+
+	for field, values in columns.items():
+		bulk_update_column("Employee Discovery", field, values)
+
+	# La colonne n'est plus dans le DocType: la supprimer réduit réellement la table
+	frappe.db.commit()
+	frappe.db.sql_ddl("ALTER TABLE `tabEmployee Discovery` DROP COLUMN `biotime_data`")
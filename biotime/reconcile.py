@@ -0,0 +1,126 @@
+import frappe
+from frappe.utils import cint, now
+
+from biotime.api import find_biotime_department_id, get_biotime_position_id
+from biotime.matching import normalize
+from biotime.mirror import refresh_employee_mirror
+from biotime.outbox import write_outbox
+
+DIFF_SAMPLE_SIZE = 50
+
+
+@frappe.whitelist()
+def reconcile_employees(apply=False):
+    """Écarts ERPNext ↔ BioTime: à créer, à mettre à jour, à désactiver
+
+    Côté BioTime, le miroir local (rafraîchi au préalable de manière incrémentale) fait
+    référence: la comparaison est locale et complète, seules les fiches BioTime modifiées
+    transitent par le réseau. apply=1 met les mises à jour et désactivations en file (BioTime Outbox).
+    """
+    frappe.only_for(("HR Manager", "System Manager"))
+    return run_reconciliation(apply=cint(apply))
+
+
+def reconcile_employees_nightly():
+    """Job quotidien: contrôle de cohérence, rapport dans BioTime Setting"""
+    return run_reconciliation()
+
+
+def run_reconciliation(apply=False):
+    refresh_employee_mirror()
+
+    erpnext = get_erpnext_records()
+    biotime = get_biotime_records()
+    diff = frappe._dict(create=[], update=[], deactivate=[], unmapped=0)
+
+    for emp_code, record in erpnext.items():
+        if record.status != "Active":
+            # Désactivé côté ERPNext: encore actif dans BioTime?
+            if emp_code in biotime and biotime[emp_code].is_active:
+                diff.deactivate.append({"emp_code": emp_code, "employee": record.employee})
+        elif emp_code not in biotime:
+            diff.create.append({"emp_code": emp_code, "employee": record.employee})
+        else:
+            fields = get_differences(record, biotime[emp_code])
+            if fields:
+                diff.update.append({"emp_code": emp_code, "employee": record.employee, "fields": fields})
+
+    # Inconnus d'ERPNext: relèvent de la découverte (Employee Discovery)
+    diff.unmapped = len([emp_code for emp_code in biotime if emp_code not in erpnext])
+
+    if apply:
+        for row in diff.update + diff.deactivate:
+            write_outbox(row["employee"], row["emp_code"], "Update")
+
+    report = (
+        f"{now()} - {len(diff.create)} à créer, {len(diff.update)} à mettre à jour, "
+        f"{len(diff.deactivate)} à désactiver, {diff.unmapped} non mappés"
+    )
+    frappe.db.set_single_value("BioTime Setting", "last_reconcile_report", report)
+    frappe.db.commit()
+
+    return {
+        "status": "success",
+        "counts": {"create": len(diff.create), "update": len(diff.update), "deactivate": len(diff.deactivate), "unmapped": diff.unmapped},
+        "create": diff.create[:DIFF_SAMPLE_SIZE],
+        "update": diff.update[:DIFF_SAMPLE_SIZE],
+        "deactivate": diff.deactivate[:DIFF_SAMPLE_SIZE],
+        "message": report,
+    }
+
+
+def get_differences(record, mirror):
+    """Champs synchronisés qui diffèrent; un département ou poste non résolu côté ERPNext n'est pas comparé
+    (l'outbox ne l'envoie pas non plus)"""
+    fields = []
+    if normalize(record.first_name) != normalize(mirror.first_name):
+        fields.append("first_name")
+    if normalize(record.last_name) != normalize(mirror.last_name):
+        fields.append("last_name")
+    if record.department_id and record.department_id != cint(mirror.department_id):
+        fields.append("department")
+    if record.position_id and record.position_id != cint(mirror.position_id):
+        fields.append("position")
+    if not mirror.is_active:
+        fields.append("is_active")
+    return fields
+
+
+def get_erpnext_records():
+    """Employés mappés (attendance_device_id), par emp_code"""
+    employees = frappe.get_all(
+        "Employee",
+        filters=[["attendance_device_id", "not in", [None, ""]]],
+        fields=["name", "attendance_device_id", "status", "employee_name", "first_name", "last_name", "department", "designation"]
+    )
+    active = [e for e in employees if e.status == "Active"]
+    department_ids = {dept: find_biotime_department_id(dept) for dept in {e.department for e in active}}
+    position_ids = {desig: get_biotime_position_id(desig) for desig in {e.designation for e in active}}
+
+    records = {}
+    for employee in employees:
+        emp_code = str(employee.attendance_device_id).strip()
+        current = records.get(emp_code)
+        # Code partagé par plusieurs fiches (ex. réembauche): privilégier l'employé actif, comme EmployeeMap
+        if current and (current.status == "Active" or employee.status != "Active"):
+            continue
+        name_parts = (employee.employee_name or "").split()
+        records[emp_code] = frappe._dict(
+            employee=employee.name,
+            status=employee.status,
+            first_name=employee.first_name or (name_parts[0] if name_parts else ""),
+            last_name=employee.last_name or " ".join(name_parts[1:]),
+            department_id=cint(department_ids.get(employee.department)),
+            position_id=cint(position_ids.get(employee.designation)),
+        )
+    return records
+
+
+def get_biotime_records():
+    """Miroir BioTime (colonnes légères, sans payload), par emp_code"""
+    return {
+        row.name: row
+        for row in frappe.db.sql("""
+            SELECT name, first_name, last_name, department_id, position_id, is_active FROM `tabBioTime Employee`
+        """, as_dict=True)
+    }
@@ -0,0 +1,80 @@
+import frappe
+from frappe import _
+from frappe.utils import cint
+
+from biotime.client import get_client
+from biotime.matching import normalize
+
+# Données de référence BioTime (départements, postes, zones) partagées entre workers
+REFERENCE_CACHE_KEY = "biotime:reference:{}"
+DEFAULT_REFERENCE_TTL = 3600
+REFERENCE_ENDPOINTS = {
+    "departments": ("/personnel/api/departments/", "dept_name", "dept_code"),
+    "positions": ("/personnel/api/positions/", "position_name", "position_code"),
+    "areas": ("/personnel/api/areas/", "area_name", "area_code"),
+}
+# Zones à éviter pour les nouveaux employés
+RESTRICTED_AREAS = ("pas autorise", "unauthorized", "restricted")
+
+
+def get_reference_data(kind, refresh=False):
+    """Liste et index (nom normalisé / code → id) d'un type de référence, depuis le cache"""
+    cache = frappe.cache()
+    key = REFERENCE_CACHE_KEY.format(kind)
+    data = None if refresh else cache.get_value(key)
+    if data is None:
+        data = fetch_reference_data(kind)
+        cache.set_value(key, data, expires_in_sec=get_reference_ttl())
+    return data
+
+
+def fetch_reference_data(kind):
+    path, name_field, code_field = REFERENCE_ENDPOINTS[kind]
+    items = []
+    for page in get_client().iter_pages(path, {"page_size": 100}):
+        for row in page.get("data") or []:
+            items.append({"id": row.get("id"), "name": row.get(name_field) or "", "code": row.get(code_field) or ""})
+
+    return {
+        "items": items,
+        "by_name": {normalize(item["name"]): item["id"] for item in items if item["name"]},
+        "by_code": {str(item["code"]): item["id"] for item in items if item["code"]},
+    }
+
+
+def get_reference_ttl():
+    return cint(frappe.db.get_single_value("BioTime Setting", "reference_ttl")) or DEFAULT_REFERENCE_TTL
+
+
+def resolve_reference_id(kind, label):
+    """Id BioTime pour un nom ou un code (None si inconnu)"""
+    if not label:
+        return None
+    data = get_reference_data(kind)
+    return data["by_name"].get(normalize(label)) or data["by_code"].get(str(label))
+
+
+def get_default_area_id():
+    """Première zone non restreinte (sinon la première zone)"""
+    areas = get_reference_data("areas")["items"]
+    for area in areas:
+        if normalize(area["name"]) not in RESTRICTED_AREAS:
+            return area["id"]
+    return areas[0]["id"] if areas else None
+
+
+def clear_reference_cache():
+    frappe.cache().delete_value([REFERENCE_CACHE_KEY.format(kind) for kind in REFERENCE_ENDPOINTS])
+
+
+@frappe.whitelist()
+def refresh_reference_data():
+    """Recharge immédiatement départements, postes et zones depuis BioTime"""
+    frappe.only_for(("HR Manager", "System Manager"))
+    counts = {kind: len(get_reference_data(kind, refresh=True)["items"]) for kind in REFERENCE_ENDPOINTS}
+    return {
+        "status": "success",
+        "counts": counts,
+        "message": _("Références BioTime rechargées: {0} départements, {1} postes, {2} zones").format(
+            counts["departments"], counts["positions"], counts["areas"])
+    }
@@ -0,0 +1,254 @@
+import json
+
+import frappe
+from datetime import timedelta
+from frappe import _
+from frappe.utils import add_to_date, cint, get_datetime, now, now_datetime
+
+from biotime.api import (
+    create_employee_checkins, finish_transactions, get_period_params, handel_transaction_pages,
+    new_transaction_stats, stream_transaction_pages
+)
+from biotime.ingestion import (
+    CheckinWriter, FailedTransactions, UnmatchedPunches, get_commit_every, mark_transactions_processed,
+    refresh_unmatched_punches
+)
+
+# État d'une sync distribuée dans Redis (nettoyé par l'agrégation, expiré sinon)
+SYNC_CACHE_KEY = "biotime:sync:{}"
+SYNC_RESULTS_KEY = "biotime:sync:{}:results"
+SYNC_DONE_KEY = "biotime:sync:{}:done"
+SYNC_TTL = 24 * 3600
+SHARD_TIMEOUT = 3600
+MATERIALIZE_LOCK_KEY = "biotime:materialize_lock"
+DEFAULT_SHARD_DAYS = 1
+DEFAULT_TRANSACTION_RETENTION_DAYS = 45
+PURGE_BATCH_SIZE = 10000
+
+STAT_FIELDS = ("total", "processed", "exists", "created", "errors", "unmatched")
+
+
+def enqueue_transaction_sync(start_date, end_date):
+    """Coordinateur: découpe la période en shards de N jours, chacun sur la file 'long'"""
+    shard_days = cint(frappe.db.get_single_value("BioTime Setting", "shard_days")) or DEFAULT_SHARD_DAYS
+    shards = split_period(start_date, end_date, shard_days)
+    if not shards:
+        return frappe._dict(sync_id=None, shards=0)
+    sync_id = frappe.generate_hash(length=10)
+
+    cache = frappe.cache()
+    cache.set_value(SYNC_CACHE_KEY.format(sync_id), {
+        "start_date": start_date,
+        "end_date": end_date,
+        "shards": len(shards),
+        "user": frappe.session.user,
+        "started": now(),
+    }, expires_in_sec=SYNC_TTL)
+
+    for shard, (shard_start, shard_end) in enumerate(shards):
+        frappe.enqueue(
+            "biotime.tasks.run_sync_shard",
+            queue="long",
+            timeout=SHARD_TIMEOUT,
+            sync_id=sync_id,
+            shard=shard,
+            start_date=shard_start,
+            end_date=shard_end,
+        )
+
+    return frappe._dict(sync_id=sync_id, shards=len(shards))
+
+
+def split_period(start_date, end_date, shard_days):
+    """[(début, fin), ...] par tranches de shard_days jours"""
+    start, end = get_datetime(start_date), get_datetime(end_date)
+    step = timedelta(days=shard_days)
+    shards = []
+    while start < end:
+        shard_end = min(start + step, end)
+        shards.append((start.strftime("%Y-%m-%d %H:%M:%S"), shard_end.strftime("%Y-%m-%d %H:%M:%S")))
+        start = shard_end
+    return shards
+
+
+def run_sync_shard(sync_id, shard, start_date, end_date):
+    """Intègre les transactions d'un shard; le dernier shard terminé lance l'agrégation"""
+    stats = new_transaction_stats()
+    stats.failed = 0
+    try:
+        handel_transaction_pages(stream_transaction_pages(get_period_params(start_date, end_date)), stats, finish=False)
+    except Exception:
+        stats.failed = 1
+        frappe.log_error(
+            message=f"Shard {shard} ({start_date} → {end_date}):\n{frappe.get_traceback()}",
+            title="Erreur Shard Sync Transactions BioTime"
+        )
+    finally:
+        record_shard_result(sync_id, shard, stats)
+
+
+def record_shard_result(sync_id, shard, stats):
+    cache = frappe.cache()
+    sync = cache.get_value(SYNC_CACHE_KEY.format(sync_id))
+    if not sync:
+        return
+
+    cache.hset(SYNC_RESULTS_KEY.format(sync_id), shard, dict(stats))
+
+    # Compteur atomique: un seul shard voit done == nombre de shards
+    done_key = cache.make_key(SYNC_DONE_KEY.format(sync_id))
+    done = cache.incr(done_key)
+    cache.expire(done_key, SYNC_TTL)
+
+    if done == sync["shards"]:
+        frappe.enqueue("biotime.tasks.aggregate_sync_shards", queue="long", sync_id=sync_id)
+
+
+def aggregate_sync_shards(sync_id):
+    """Combine les résultats des shards en un rapport unique"""
+    cache = frappe.cache()
+    sync = cache.get_value(SYNC_CACHE_KEY.format(sync_id))
+    if not sync:
+        return
+
+    results = cache.hgetall(SYNC_RESULTS_KEY.format(sync_id)) or {}
+    stats = new_transaction_stats()
+    failed = 0
+    for result in results.values():
+        for field in STAT_FIELDS:
+            stats[field] += cint(result.get(field))
+        failed += cint(result.get("failed"))
+
+    report = (
+        f"{now()} - Période {sync['start_date']} → {sync['end_date']}: "
+        f"{sync['shards']} shards ({failed} en échec), {stats.processed} transactions, "
+        f"{stats.created} créées, {stats.exists} déjà présentes, {stats.errors} erreurs"
+    )
+    frappe.db.set_single_value("BioTime Setting", "last_sync_report", report)
+    frappe.db.commit()
+
+    finish_transactions(stats, user=sync["user"])
+
+    cache.delete_value([
+        SYNC_CACHE_KEY.format(sync_id),
+        SYNC_RESULTS_KEY.format(sync_id),
+        SYNC_DONE_KEY.format(sync_id),
+    ])
+
+
+@frappe.whitelist()
+def enqueue_replay_failed_transactions(emp_code=None):
+    """Rejoue en arrière-plan les BioTime Failed Transaction (toutes, ou d'un emp_code)"""
+    frappe.only_for(("HR Manager", "System Manager"))
+    frappe.enqueue(
+        "biotime.tasks.replay_failed_transactions",
+        queue="long",
+        timeout=SHARD_TIMEOUT,
+        emp_codes=[emp_code] if emp_code else None,
+        user=frappe.session.user,
+    )
+    return {"status": "queued", "message": _("Rejeu des transactions en échec lancé en arrière-plan")}
+
+
+def replay_failed_transactions(emp_codes=None, user=None):
+    """Rejoue uniquement les transactions en file, par lots; celles qui passent en sont retirées"""
+    filters = {"emp_code": ["in", emp_codes]} if emp_codes else {}
+    batch_size = get_commit_every()
+    stats = frappe._dict(replayed=0, resolved=0)
+    last_name = ""
+
+    while True:
+        rows = frappe.get_all(
+            "BioTime Failed Transaction",
+            filters={**filters, "name": [">", last_name]},
+            fields=["name", "emp_code", "payload"],
+            order_by="name asc",
+            limit_page_length=batch_size
+        )
+        if not rows:
+            break
+        last_name = rows[-1].name
+
+        rows = [row for row in rows if row.payload]
+        failed = FailedTransactions()
+        writer = CheckinWriter(failed=failed)
+        create_employee_checkins([json.loads(row.payload) for row in rows], writer)
+        writer.close()
+
+        # Encore en échec: tentative +1; les autres (créées ou déjà présentes) sont résolues
+        refailed = set(failed.failures)
+        failed.save()
+        resolved = [row.name for row in rows if row.name not in refailed]
+        if resolved:
+            frappe.db.delete("BioTime Failed Transaction", {"name": ["in", resolved]})
+            # Récapitulatifs des badges rejoués: compteurs à jour, retirés s'il ne reste rien
+            refresh_unmatched_punches({row.emp_code for row in rows if row.emp_code})
+            frappe.db.commit()
+
+        stats.replayed += len(rows)
+        stats.resolved += len(resolved)
+
+    if user:
+        frappe.publish_realtime("msgprint", _("Rejeu terminé: {0} transactions rejouées, {1} résolues, {2} toujours en échec").format(
+            stats.replayed, stats.resolved, stats.replayed - stats.resolved), user=user)
+    return stats
+
+
+def materialize_transactions():
+    """Transforme les BioTime Transaction non traitées en Employee Checkin, par lots"""
+    cache = frappe.cache()
+    # Un seul matérialiseur à la fois: celui en cours traite aussi les lignes arrivées entre-temps
+    lock = cache.lock(cache.make_key(MATERIALIZE_LOCK_KEY), timeout=SHARD_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        return
+
+    batch_size = get_commit_every()
+    unmatched = UnmatchedPunches()
+    failed = FailedTransactions()
+    writer = CheckinWriter(batch_size=batch_size, failed=failed)
+    try:
+        while True:
+            rows = frappe.get_all(
+                "BioTime Transaction",
+                filters={"processed": 0},
+                fields=["name", "payload"],
+                order_by="punch_time asc",
+                limit_page_length=batch_size
+            )
+            if not rows:
+                break
+
+            create_employee_checkins([json.loads(row.payload) for row in rows if row.payload], writer, unmatched)
+            # Check-ins et échecs commités avant de marquer le lot (rejouable si interrompu)
+            writer.flush()
+            failed.save()
+            mark_transactions_processed([row.name for row in rows])
+    finally:
+        writer.close()
+        failed.save()
+        unmatched.save()
+        try:
+            lock.release()
+        except Exception:
+            # Verrou expiré entre-temps: rien à libérer
+            pass
+
+
+def purge_processed_transactions():
+    """Job quotidien: supprime les BioTime Transaction traitées au-delà de la rétention (déjà en Employee Checkin)"""
+    days = cint(frappe.db.get_single_value("BioTime Setting", "transaction_retention_days")) or DEFAULT_TRANSACTION_RETENTION_DAYS
+    cutoff = add_to_date(now_datetime(), days=-days)
+    deleted = 0
+    # Par paquets: pas de long verrou sur la table de staging
+    while True:
+        frappe.db.sql("""
+            DELETE FROM `tabBioTime Transaction`
+            WHERE processed = 1 AND creation < %s
+            LIMIT %s
+        """, (cutoff, PURGE_BATCH_SIZE))
+        count = frappe.db.sql("SELECT ROW_COUNT()")[0][0]
+        frappe.db.commit()
+        deleted += count
+        if count < PURGE_BATCH_SIZE:
+            break
+    return deleted
@@ -0,0 +1,81 @@
+import time
+
+import frappe
+
+# Au plus un événement realtime toutes les N ms, ou dès que la progression avance de X %
+PROGRESS_INTERVAL_MS = 1000
+PROGRESS_STEP_PERCENT = 5
+
+
+class ProgressReporter:
+    """publish_progress limité dans le temps et en pas de pourcentage; le 100 % final est toujours envoyé"""
+
+    def __init__(self, title, total=0, interval_ms=PROGRESS_INTERVAL_MS, step=PROGRESS_STEP_PERCENT, description=None):
+        self.title = title
+        self.total = total
+        self.interval = interval_ms / 1000
+        self.step = step
+        self.description = description
+        self.done = 0
+        self.last_percent = None
+        self.last_time = 0
+
+    def update(self, done=None, total=None, description=None):
+        """Nouvelle position (par défaut: un élément de plus)"""
+        self.done = self.done + 1 if done is None else done
+        if total:
+            self.total = total
+        if description:
+            self.description = description
+
+        percent = self.get_percent()
+        if percent >= 100 or percent == self.last_percent:
+            # 100 % réservé à finish(): un seul événement final
+            return
+
+        elapsed = time.monotonic() - self.last_time
+        if self.last_percent is None or elapsed >= self.interval or percent - self.last_percent >= self.step:
+            self.publish(percent)
+
+    def finish(self, description=None):
+        self.publish(100, description or self.description)
+
+    def get_percent(self):
+        total = max(self.total or 0, self.done)
+        return int(self.done * 100 / total) if total else 0
+
+    def publish(self, percent, description=None):
+        self.last_percent = percent
+        self.last_time = time.monotonic()
+        frappe.publish_progress(percent, title=self.title, description=description or self.description)
+
+
+def bulk_set_values(doctype, updates):
+    """Mises à jour groupées {name: {champ: valeur}}: une requête UPDATE par couple (champ, valeur)"""
+    groups = {}
+    for name, values in updates.items():
+        for field, value in values.items():
+            groups.setdefault((field, value), []).append(name)
+
+    timestamp = frappe.utils.now()
+    for (field, value), names in groups.items():
+        frappe.db.sql(f"""
+            UPDATE `tab{doctype}`
+            SET `{field}` = %(value)s, modified = %(timestamp)s, modified_by = %(user)s
+            WHERE name IN %(names)s
+        """, {"value": value, "timestamp": timestamp, "user": frappe.session.user, "names": tuple(names)})
+
+
+def bulk_update_column(doctype, field, values, batch_size=500):
+    """Valeurs distinctes {name: valeur} d'un même champ: une requête UPDATE ... CASE par lot"""
+    names = list(values)
+    timestamp = frappe.utils.now()
+    for start in range(0, len(names), batch_size):
+        batch = names[start:start + batch_size]
+        cases = " ".join(["WHEN %s THEN %s"] * len(batch))
+        params = [item for name in batch for item in (name, values[name])]
+        frappe.db.sql(f"""
+            UPDATE `tab{doctype}`
+            SET `{field}` = CASE name {cases} END, modified = %s, modified_by = %s
+            WHERE name IN %s
+        """, params + [timestamp, frappe.session.user, tuple(batch)])